@@ -1,5 +1,4 @@
-import download_video
-import download_gcsv
+import download_media
 from logger import Logger
 import config
 
@@ -24,8 +23,5 @@ def check_devices_and_file_existance(device_names: list):
 
     if device_name:
 
-        logger.info(f"Saving videos")
-        download_video.run(device_name, device_video_dir)
-
-        logger.info(f"Saving GCSV")
-        download_gcsv.run(device_name, device_gcsv_dir)
+        logger.info(f"Saving videos and GCSV")
+        download_media.run(device_name, device_video_dir, device_gcsv_dir)
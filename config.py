@@ -1,12 +1,19 @@
 import os
+import copy
 import json
 import warnings
 
 
+_cache = {"mtime": None, "config": None}
+
+
 def getConfiguration() -> dict:
     """
     Load the configuration from the config.json file.
 
+    The file is parsed again only when it changes, so long running processes
+    keep it in memory but still see the edits.
+
     Args:
         - None
 
@@ -15,9 +22,12 @@ def getConfiguration() -> dict:
     """
     directory = os.path.dirname(os.path.abspath(__file__))
     config_path = os.path.join(directory, "config.json")
-    with open(config_path, "r") as config_file:
-        config = json.load(config_file)
-    return config
+    mtime = os.path.getmtime(config_path)
+    if _cache["mtime"] != mtime:
+        with open(config_path, "r") as config_file:
+            _cache["config"] = json.load(config_file)
+        _cache["mtime"] = mtime
+    return copy.deepcopy(_cache["config"])
 
 
 def getValidDevices(device_names: list) -> list:
@@ -63,6 +73,90 @@ def getGCSVFolder() -> str:
     return gcsv_dir
 
 
+def getSyncFolder() -> str:
+    """
+    Get the folder for synchronized sensor CSV files from the configuration file.
+    """
+    config = getConfiguration()
+
+    # Retrieve the sync directory, older configurations do not define it
+    sync_dir = config["paths"].get("sync_dir", "./synced")
+
+    return sync_dir
+
+
+def getCacheFolder() -> str:
+    """
+    Get the folder for cached analysis results from the configuration file.
+    """
+    config = getConfiguration()
+
+    # Retrieve the cache directory, older configurations do not define it
+    cache_dir = config["paths"].get("cache_dir", "./cache")
+
+    return cache_dir
+
+
+def getOutputFolder() -> str:
+    """
+    Get the folder for the videos and tables produced by the pipeline from the configuration file.
+    """
+    config = getConfiguration()
+
+    # Retrieve the output directory, older configurations do not define it
+    output_dir = config["paths"].get("output_dir", "./output")
+
+    return output_dir
+
+
+def getAudioFolder() -> str:
+    """
+    Get the folder for the audio extracted from the videos from the configuration file.
+    """
+    config = getConfiguration()
+
+    # Retrieve the audio directory, older configurations do not define it
+    audio_dir = config["paths"].get("audio_dir", "./audio")
+
+    return audio_dir
+
+
+def getIndexFolder() -> str:
+    """
+    Get the folder of the IMU index from the configuration file.
+    """
+    config = getConfiguration()
+
+    # Retrieve the index directory, older configurations do not define it
+    index_dir = config["paths"].get("index_dir", "./imu_index")
+
+    return index_dir
+
+
+def getStabilizationSettings() -> dict:
+    """
+    Get the settings of the batch stabilization from the configuration file.
+
+    Returns:
+        - settings (dict): "binary" (path of the gyroflow executable),
+            "cores_per_job", "memory_per_job_gb", "max_jobs" (None for no
+            limit) and "retries".
+    """
+    config = getConfiguration()
+
+    # Older configurations do not define them, use the defaults
+    settings = {
+        "binary": "./Gyroflow/gyroflow",
+        "cores_per_job": 4,
+        "memory_per_job_gb": 4,
+        "max_jobs": None,
+        "retries": 1,
+    }
+    settings.update(config.get("stabilization", {}))
+
+    return settings
+
+
 def createDirectories() -> None:
     """
     Create directories for video and GCSV files.
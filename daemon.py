@@ -0,0 +1,252 @@
+import os
+import re
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+import fileHandling
+import download_media
+from logger import Logger
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+MOUNTINFO = "/proc/self/mountinfo"
+
+
+def _mount_ids() -> dict:
+    """
+    Mount point -> id of its mount. Ids are reused once a mount is gone, see
+    _disk_sequence. Empty where /proc is not available.
+    """
+    ids = {}
+    try:
+        with open(MOUNTINFO, "r") as f:
+            for line in f:
+                fields = line.split()
+                # Spaces, tabs, newlines and backslashes are escaped as \ooo
+                path = re.sub(
+                    r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[4]
+                )
+                ids[path] = fields[0]
+    except OSError:
+        pass
+    return ids
+
+
+def _disk_sequence(device_number: int) -> str:
+    """
+    Sequence number the kernel gives a disk every time it is attached
+    (/sys/block/<disk>/diskseq, Linux 5.15 and later), for the filesystem with
+    the given device number. None if it is not a block device or not known.
+    """
+    folder = f"/sys/dev/block/{os.major(device_number)}:{os.minor(device_number)}"
+    # Partitions have it in the folder of their disk
+    for path in (folder, os.path.join(folder, "..")):
+        try:
+            with open(os.path.join(path, "diskseq"), "r") as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    return None
+
+
+class DeviceDaemon:
+    """
+    Long running service that offloads every allowed camera when it is
+    mounted.
+
+    Mount events are taken from udev (pyudev) when it is installed. Every
+    event only wakes the daemon up, the mounts themselves are read from the
+    media folder, so a card is handled once it is really mounted. Without
+    pyudev the media folder is polled every interval seconds, which is a
+    directory listing and never a new process.
+
+    The configuration, the logger and the pool of offload workers are created
+    once and kept for the whole life of the daemon.
+    """
+
+    def __init__(
+        self,
+        media_folder: str = None,
+        interval: float = 2.0,
+        mount_timeout: float = 30.0,
+        workers: int = 2,
+        on_offloaded=None,
+        log_file: str = None,
+    ):
+        """
+        Args:
+            media_folder (str): Folder where the devices are mounted. Defaults
+                to /media/<user>.
+            interval (float): Seconds between checks of the media folder.
+            mount_timeout (float): Seconds to wait for the mount after a udev
+                event.
+            workers (int): Devices offloaded at the same time.
+            on_offloaded (function): Called with the mount path and the copy
+                statistics after every offload, in the worker thread.
+            log_file (str): Path of the log file.
+        """
+        directory = os.path.dirname(os.path.abspath(__file__))
+        self.media_folder = media_folder or fileHandling.getMediaFolder()
+        self.interval = interval
+        self.mount_timeout = mount_timeout
+        self.on_offloaded = on_offloaded
+        self.logger = Logger(
+            name="AppLogger", log_file=log_file or os.path.join(directory, "App.log")
+        ).get_logger()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.active = {}  # Mount path -> future of its offload
+        self.replugged = set()  # Mounted again while their offload was running
+        self.known = {}  # Mount path -> identity of the mount, see mounted_devices
+        self.stopped = threading.Event()
+        self.monitor = self._udev_monitor()
+
+    def _udev_monitor(self):
+        if pyudev is None:
+            self.logger.info("pyudev not installed, polling the media folder")
+            return None
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by(subsystem="block")
+        monitor.start()
+        return monitor
+
+    def mounted_devices(self) -> dict:
+        """
+        Devices that are mounted now.
+
+        Returns:
+            - mounted (dict): Mount path -> identity of the mount: the mount
+                id, the device number and the disk sequence number. The disk
+                sequence changes on every attach, so a card unplugged and
+                plugged again between two checks is a new mount even if it
+                gets the same path, mount id and device number.
+        """
+        ids = _mount_ids()
+        mounted = {}
+        for device in fileHandling.getConnectedDevices(self.media_folder):
+            if not os.path.ismount(device):
+                continue
+            try:
+                device_number = os.stat(device).st_dev
+            except OSError:
+                # Unmounted meanwhile
+                continue
+            mounted[device] = (
+                ids.get(device),
+                device_number,
+                _disk_sequence(device_number),
+            )
+        return mounted
+
+    def _new_mounts(self, mounted: dict) -> list:
+        return sorted(
+            device
+            for device, identity in mounted.items()
+            if self.known.get(device) != identity
+        )
+
+    def check(self) -> list:
+        """
+        Offload the devices mounted since the last check.
+
+        A device mounted again while its previous offload is still running is
+        offloaded again once that offload finishes, so the files recorded in
+        between are not missed.
+
+        Returns:
+            - new (list): Mount paths of the devices that were submitted.
+        """
+        mounted = self.mounted_devices()
+        new = self._new_mounts(mounted)
+        self.known = mounted
+
+        # Unplugged ones will come back as new mounts
+        self.replugged &= set(mounted)
+        retry = sorted(
+            device for device in self.replugged if self.active[device].done()
+        )
+        self.replugged.difference_update(retry)
+
+        submitted = []
+        for device in (config.getValidDevices(new) if new else []) + retry:
+            if device in self.active and not self.active[device].done():
+                self.logger.info(f"Device mounted during its offload: {device}")
+                self.replugged.add(device)
+                continue
+            self.logger.info(f"Device mounted: {device}")
+            self.active[device] = self.pool.submit(self._offload, device)
+            submitted.append(device)
+        return submitted
+
+    def _offload(self, device: str) -> dict:
+        start = time.perf_counter()
+        try:
+            stats = download_media.run(
+                [device], config.getVideoFolder(), config.getGCSVFolder()
+            )
+        except Exception:
+            self.logger.exception(f"Offload of {device} failed")
+            raise
+        self.logger.info(
+            f"Offload of {device} finished in {time.perf_counter() - start:.1f} s"
+        )
+        if self.on_offloaded is not None:
+            self.on_offloaded(device, stats)
+        return stats
+
+    def _wait(self) -> None:
+        """
+        Sleep until the next check: a udev event followed by its mount, or
+        interval seconds.
+        """
+        if self.monitor is None:
+            self.stopped.wait(self.interval)
+            return
+
+        event = self.monitor.poll(timeout=self.interval)
+        if event is None or event.action != "add":
+            return
+        # The event comes before the mount, wait for it to appear
+        deadline = time.monotonic() + self.mount_timeout
+        while time.monotonic() < deadline and not self.stopped.is_set():
+            if self._new_mounts(self.mounted_devices()):
+                return
+            self.stopped.wait(0.2)
+
+    def run(self) -> None:
+        """
+        Check the devices until stop is called or the process is interrupted.
+        The devices already mounted when the daemon starts are offloaded too.
+        """
+        self.logger.info(f"Watching {self.media_folder}")
+        try:
+            while not self.stopped.is_set():
+                self.check()
+                self._wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.pool.shutdown(wait=True)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Offload the allowed cameras as soon as they are mounted."
+    )
+    parser.add_argument("-m", "--media", help="Folder where devices are mounted")
+    parser.add_argument(
+        "-i", "--interval", type=float, default=2.0, help="Seconds between checks"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=2, help="Devices offloaded at once"
+    )
+    args = parser.parse_args()
+
+    DeviceDaemon(args.media, args.interval, workers=args.workers).run()
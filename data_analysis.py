@@ -1,31 +1,236 @@
+import io
+import os
+import time
+import queue
+import hashlib
+import threading
+import numpy as np
 import pandas as pd
 from ultralytics import YOLO
 import cv2
 from tqdm import tqdm
+import config
+import ffmpegUtils
+import sync
+
+
+def _es_binario(path):
+    """
+    Whether a synchronized file is in one of the binary formats of sync.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    return extension in sync.LOADERS and extension != ".csv"
 
 
 # Función para cargar y analizar el CSV
 def cargar_csv(path):
     """
     Loads the CSV file containing synchronized data.
+    The columns returned by sync.synchronize_data and the binary files
+    written by sync (".npy", ".npz", ".parquet") are also accepted.
     """
+    if isinstance(path, dict):
+        return pd.DataFrame(path)
+    if _es_binario(path):
+        return pd.DataFrame(sync.load_synced(path))
     return pd.read_csv(
         path
     )  # , header=0, names=['frame', 'timestamp', 'rx', 'ry', 'rz', 'ax', 'ay', 'az'])
 
 
+EJES = ["ax", "ay", "az"]
+
+
+class DetectorFrenazos:
+    """
+    Incremental brake detector with constant memory.
+
+    Keeps a running mean and variance of every acceleration axis and flags the
+    samples below mean - desviaciones * std, the same rule as
+    calcular_umbrales and detectar_frenazos. With alpha=None the statistics
+    are cumulative (Welford), so after the whole file has been fed the
+    thresholds are the batch ones. With an alpha in (0, 1) they are
+    exponentially weighted, which follows slow drifts of the sensor on long
+    live recordings.
+    """
+
+    def __init__(self, desviaciones=3, alpha=None, min_muestras=100):
+        """
+        Args:
+            desviaciones (float): Standard deviations below the mean.
+            alpha (float): Weight of every new sample for the EWMA, None for
+                cumulative statistics.
+            min_muestras (int): Samples needed before anything is flagged.
+        """
+        self.desviaciones = desviaciones
+        self.alpha = alpha
+        self.min_muestras = min_muestras
+        self.n = np.zeros(len(EJES))
+        self.mean = np.zeros(len(EJES))
+        self.m2 = np.zeros(len(EJES))  # Sum of squared deviations (Welford)
+        self.var = np.zeros(len(EJES))  # Variance (EWMA)
+
+    def _std(self):
+        if self.alpha is not None:
+            return np.sqrt(self.var)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(self.m2 / (self.n - 1))
+
+    def umbrales(self):
+        """
+        Returns the current threshold of every axis, like calcular_umbrales.
+        """
+        limites = self.mean - self.desviaciones * self._std()
+        return {eje: float(limite) for eje, limite in zip(EJES, limites)}
+
+    def _actualizar_welford(self, muestras):
+        # Merge the statistics of the block with the accumulated ones (Chan)
+        validas = ~np.isnan(muestras)
+        n_b = validas.sum(axis=0)
+        if not n_b.any():
+            return
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_b = np.where(n_b > 0, np.nansum(muestras, axis=0) / n_b, 0.0)
+        m2_b = np.nansum((muestras - mean_b) ** 2, axis=0)
+
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            peso = np.where(n > 0, n_b / n, 0.0)
+        self.mean = self.mean + delta * peso
+        self.m2 = self.m2 + m2_b + delta**2 * self.n * peso
+        self.n = n
+
+    def _actualizar_ewma(self, muestras):
+        # Every sample is compared with the statistics that include it
+        limites = np.empty_like(muestras)
+        for i, muestra in enumerate(muestras):
+            validas = ~np.isnan(muestra)
+            primera = validas & (self.n == 0)
+            self.mean[primera] = muestra[primera]
+            delta = np.where(validas, muestra - self.mean, 0.0)
+            self.mean += self.alpha * delta
+            self.var = np.where(
+                validas, (1 - self.alpha) * (self.var + self.alpha * delta**2), self.var
+            )
+            self.n += validas
+            limites[i] = self.mean - self.desviaciones * np.sqrt(self.var)
+        return limites
+
+    def actualizar(self, muestras):
+        """
+        Adds a block of samples and flags the ones that are brakes.
+
+        With cumulative statistics the samples of the block are compared with
+        the thresholds after adding the whole block, so feeding a finished
+        file as a single block gives the same result as detectar_frenazos.
+
+        Args:
+            - muestras (np.ndarray): Array of shape (n, 3) with the ax, ay
+                and az columns.
+
+        Returns:
+            - frenazo (np.ndarray): Boolean mask of the brake samples.
+        """
+        muestras = np.asarray(muestras, dtype=np.float64).reshape(-1, len(EJES))
+        if self.alpha is None:
+            self._actualizar_welford(muestras)
+            limites = self.mean - self.desviaciones * self._std()
+        else:
+            limites = self._actualizar_ewma(muestras)
+
+        frenazo = (muestras < limites).any(axis=1)
+        if self.n.min() < self.min_muestras:
+            frenazo[:] = False
+        return frenazo
+
+
 # Calcular umbrales estadísticos para frenazos
 def calcular_umbrales(data, desviaciones=3):
     """
     Calculates statistical thresholds for detecting sudden stops (frenazos).
+
+    The statistics are accumulated with DetectorFrenazos, so the thresholds
+    are the same ones a live detector reaches at the end of the file.
     """
-    stats = data[["ax", "ay", "az"]].describe()  # Axis statistics
-    thresholds = {
-        eje: stats[eje]["mean"] - desviaciones * stats[eje]["std"]
-        for eje in ["ax", "ay", "az"]
-    }
-    # Calculate thresholds based on mean and std deviation
-    return thresholds
+    detector = DetectorFrenazos(desviaciones)
+    detector.actualizar(data[EJES].to_numpy())
+    return detector.umbrales()
+
+
+def leer_bloques(path, block_rows=4096, follow=False, timeout=10.0):
+    """
+    Reads the timestamp and acceleration of a synchronized file or a GCSV
+    file in blocks. CSV and GCSV files are not loaded whole.
+
+    With follow=True the file can still be being written or copied off the
+    camera, see sync.follow_lines.
+
+    Returns:
+        - Generator of DataFrames with the "timestamp", "ax", "ay" and "az"
+            columns.
+    """
+    if _es_binario(path):
+        # Binary files are small, they are read at once and split
+        data = cargar_csv(path)[["timestamp"] + EJES]
+        for start in range(0, len(data), block_rows):
+            yield data.iloc[start : start + block_rows]
+        return
+
+    if path.lower().endswith(".gcsv"):
+        gcsv_columns = [sync.GCSV_COLUMNS.index(name) for name in ["t"] + EJES]
+        for block in sync.iter_gcsv_blocks(path, block_rows, follow, timeout):
+            yield pd.DataFrame(block[:, gcsv_columns], columns=["timestamp"] + EJES)
+        return
+
+    with open(path, "rb") as f:
+        lines = sync.follow_lines(f, follow, timeout)
+        header = next(line for line in lines if line)
+        names = header.strip().split(",")
+
+        rows = []
+        for line in lines:
+            if line:
+                rows.append(line)
+            if rows and (line is None or len(rows) >= block_rows):
+                yield _leer_filas(rows, names)
+                rows = []
+        if rows:
+            yield _leer_filas(rows, names)
+
+
+def _leer_filas(rows, names):
+    """
+    Parses CSV lines into the timestamp and acceleration columns.
+    Empty fields are read as NaN, like pandas.read_csv.
+    """
+    block = pd.read_csv(io.StringIO("".join(rows)), header=None, names=names)
+    return block[["timestamp"] + EJES]
+
+
+def detectar_frenazos_en_vivo(
+    path,
+    detector=None,
+    block_rows=4096,
+    follow=False,
+    timeout=10.0,
+):
+    """
+    Detects sudden stops while the file is read, with constant memory.
+
+    Every block of samples updates the detector and the brakes found in it are
+    returned at once, so with follow=True detection runs while the file is
+    still being copied. Pass a DetectorFrenazos to choose its parameters and
+    to read its final thresholds afterwards.
+
+    Returns:
+        - Generator of DataFrames with the brake rows of every block.
+    """
+    detector = detector or DetectorFrenazos()
+    for block in leer_bloques(path, block_rows, follow, timeout):
+        frenazo = detector.actualizar(block[EJES].to_numpy())
+        if frenazo.any():
+            yield block[frenazo]
 
 
 # Detectar frenazos a partir de umbrales
@@ -41,139 +246,705 @@ def detectar_frenazos(data, thresholds):
     return data[data["frenazo"]]
 
 
+# Asignar a cada instante el segmento que lo contiene
+def asignar_segmentos(timestamps, segments_df):
+    """
+    Returns the index of the segment that contains each timestamp, or -1 when
+    it is outside every segment. Segments must be sorted and not overlap.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    starts = segments_df["start"].to_numpy(dtype=np.float64)
+    ends = segments_df["end"].to_numpy(dtype=np.float64)
+
+    ids = np.searchsorted(starts, timestamps, side="right") - 1
+    inside = ids >= 0
+    inside[inside] = timestamps[inside] < ends[ids[inside]]
+    return np.where(inside, ids, -1)
+
+
 # Segmentar video y contar frenazos en cada segmento
 def segmentar_video(data, frenazos, segment_duration=5):
     """
     Segments the video into intervals and counts the number of frenazos in each segment.
     """
     total_time = data["timestamp"].max()  # Get the maximum timestamp
-    segments = [
-        (start, min(start + segment_duration, total_time))
-        for start in range(0, int(total_time) + 1, segment_duration)
-    ]
+    starts = np.arange(0, int(total_time) + 1, segment_duration, dtype=np.float64)
+    ends = np.minimum(starts + segment_duration, total_time)
     # Create segments of the video based on the segment duration
 
-    segment_data = []  # Initialize list to store segment data
-    for start, end in segments:  # Create segments of the video
-        frenazos_in_segment = frenazos[
-            (frenazos["timestamp"] >= start) & (frenazos["timestamp"] < end)
-        ]
-        # Count the number of frenazos in the current segment
-
-        # Calculate the average number of cars and persons per frame
-        segment_data.append(
-            {
-                "start": start,
-                "end": end,
-                "duration": end - start,
-                "frenazo_count": len(frenazos_in_segment),
-                "car_count_per_frame": [],
-                "person_count_per_frame": [],
-                "score": 0,
-            }
-        )
+    segments_df = pd.DataFrame(
+        {"start": starts, "end": ends, "duration": ends - starts, "score": 0.0}
+    )
 
-    return pd.DataFrame(segment_data)
+    # Count the number of frenazos in each segment in a single pass
+    ids = asignar_segmentos(frenazos["timestamp"], segments_df)
+    segments_df.insert(
+        3, "frenazo_count", np.bincount(ids[ids >= 0], minlength=len(segments_df))
+    )
+    return segments_df
 
 
 # Detectar objetos usando YOLO
 
 
-def detectar_objetos_yolo(video_path, segments_df, confidence=0.3):
+def _nueva_etapa():
     """
-    Detects objects in the video using YOLO and counts the number of cars and persons.
+    Creates the statistics of one pipeline stage.
     """
-    model = YOLO("yolov8n.pt")  # Load YOLO model
-    cap = cv2.VideoCapture(video_path)  # Open video file
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))  # Get total number of frames
+    return {"frames": 0, "seconds": 0.0, "queue_max": 0, "queue_sum": 0}
+
 
-    for _ in tqdm(
-        range(total_frames), desc="Procesando YOLO", unit="frame"
+def _resumir_etapas(stats):
+    """
+    Adds the frames/sec and mean queue depth to the statistics of every stage.
+    """
+    for etapa in stats.values():
+        etapa["fps"] = etapa["frames"] / etapa["seconds"] if etapa["seconds"] else 0.0
+        etapa["queue_mean"] = (
+            etapa["queue_sum"] / etapa["frames"] if etapa["frames"] else 0.0
+        )
+    return stats
+
+
+def _medir_etapa(items, etapa):
+    """
+    Yields the items of an iterator adding the time spent producing them to
+    the statistics of the stage.
+    """
+    iterador = iter(items)
+    fin = object()
+    while True:
+        t0 = time.perf_counter()
+        item = next(iterador, fin)
+        etapa["seconds"] += time.perf_counter() - t0
+        if item is fin:
+            return
+        etapa["frames"] += 1
+        yield item
+
+
+def _hilo_productor(items, etapa, queue_size):
+    """
+    Consumes an iterator in a background thread and yields its items through a
+    bounded queue, so the producer and the caller run at the same time.
+
+    When the caller stops early, because it failed or closed the generator,
+    the thread stops after its current item and is joined, so it never stays
+    blocked on the full queue or keeps using the iterator.
+    """
+    cola = queue.Queue(maxsize=queue_size)
+    fin = object()
+    errores = []
+    parar = threading.Event()
+
+    def poner(item):
+        # Returns False once the caller stopped reading
+        while not parar.is_set():
+            try:
+                cola.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producir():
+        try:
+            for item in _medir_etapa(items, etapa):
+                if not poner(item):
+                    return
+                etapa["queue_sum"] += cola.qsize()
+                etapa["queue_max"] = max(etapa["queue_max"], cola.qsize())
+        except Exception as error:
+            errores.append(error)
+        finally:
+            poner(fin)
+
+    hilo = threading.Thread(target=producir, daemon=True)
+    hilo.start()
+    try:
+        while True:
+            item = cola.get()
+            if item is fin:
+                break
+            yield item
+    finally:
+        parar.set()
+        hilo.join()
+    if errores:
+        raise errores[0]
+
+
+def _hilo_consumidor(funcion, etapa, queue_size):
+    """
+    Starts a background thread that calls funcion on every item put in the
+    returned queue. Putting None stops the thread.
+    """
+    cola = queue.Queue(maxsize=queue_size)
+
+    def consumir():
+        while True:
+            item = cola.get()
+            if item is None:
+                break
+            t0 = time.perf_counter()
+            funcion(*item)
+            etapa["seconds"] += time.perf_counter() - t0
+            etapa["frames"] += 1
+            etapa["queue_sum"] += cola.qsize()
+            etapa["queue_max"] = max(etapa["queue_max"], cola.qsize())
+
+    hilo = threading.Thread(target=consumir, daemon=True)
+    hilo.start()
+    return cola, hilo
+
+
+def _dibujar_objetos(frame, results, names):
+    """
+    Draws the boxes and labels of one YOLO result on the frame.
+    """
+    for box in results.boxes:
+        label = names[int(box.cls[0])]
+        x1, y1, x2, y2 = map(int, box.xyxy[0])
+
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.putText(
+            frame,
+            label,
+            (x1, y1 - 10),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.5,
+            (0, 255, 0),
+            2,
+        )
+
+
+def _decodificar_frames(cap, needed):
+    """
+    Reads the video and yields (frame index, frame) for every needed frame.
+    The other frames are only grabbed and never converted.
+    """
+    for frame_idx in tqdm(
+        range(len(needed)), desc="Procesando YOLO", unit="frame"
     ):  # Read each frame
-        ret, frame = cap.read()  # Read frame from video
-        if not ret:  # If frame not read, break the loop
+        if not cap.grab():  # If frame not read, break the loop
             break
 
-        timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000  # Get current timestamp
-        segmento_actual = segments_df[
-            (segments_df["start"] <= timestamp) & (segments_df["end"] > timestamp)
-        ]
-
-        if segmento_actual.empty:
+        if not needed[frame_idx]:
             continue
 
-        results = model(frame, verbose=False, conf=confidence)[0]
-        car_count = 0
-        person_count = 0
-
-        for box in results.boxes:
-            cls_id = int(box.cls[0])
-            label = model.names[cls_id]
-            x1, y1, x2, y2 = map(int, box.xyxy[0])
-
-            if label == "car":
-                car_count += 1
-            elif label == "person":
-                person_count += 1
-
-            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            cv2.putText(
-                frame,
-                label,
-                (x1, y1 - 10),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.5,
-                (0, 255, 0),
-                2,
-            )
+        ret, frame = cap.retrieve()
+        if not ret:
+            break
+        yield frame_idx, frame
 
-        idx = segmento_actual.index[0]
-        segments_df.at[idx, "car_count_per_frame"].append(car_count)
-        segments_df.at[idx, "person_count_per_frame"].append(person_count)
 
-    cap.release()
-    return segments_df
+# Caché de detecciones en disco
+def hash_video(video_path, chunk_size=8 * 1024 * 1024):
+    """
+    Returns a short content hash of a video file.
 
+    Only the size and the first and last chunk_size bytes are hashed, which is
+    enough to tell recordings apart without reading several GB per run.
+    """
+    size = os.path.getsize(video_path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(video_path, "rb") as f:
+        digest.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(chunk_size, size - chunk_size))
+            digest.update(f.read(chunk_size))
+    return digest.hexdigest()
 
-# Calcular la puntuación final de cada segmento
+
+def ruta_cache(video_path, model_name, confidence):
+    """
+    Path of the detection cache of a video, model and confidence.
+    """
+    model_stem = os.path.splitext(os.path.basename(model_name))[0]
+    filename = f"{hash_video(video_path)}_{model_stem}_conf{confidence:g}.npz"
+    return os.path.join(config.getCacheFolder(), filename)
 
 
-def calcular_puntuacion(segments_df, pesos={"frenazo": 2, "car": 1, "person": 1.5}):
+def _cajas_vacias():
     """
-    Calculates the final score for each segment based on the number of frenazos, cars, and persons detected.
+    Returns an empty set of detections.
+    """
+    return {
+        "inferred": np.zeros(0, dtype=np.int32),
+        "box_frame": np.zeros(0, dtype=np.int32),
+        "box_class": np.zeros(0, dtype=np.int16),
+        "box_conf": np.zeros(0, dtype=np.float32),
+        "box_xyxy": np.zeros((0, 4), dtype=np.float32),
+    }
+
+
+def cargar_cache_detecciones(cache_path):
+    """
+    Loads the detections stored in a cache file, or None if there is none.
+    The result has the inferred frame indices, one entry per box and the
+    class names of the model.
+    """
+    if not os.path.exists(cache_path):
+        return None
+    with np.load(cache_path) as cache:
+        return {key: cache[key] for key in cache.files}
+
+
+def guardar_cache_detecciones(cache_path, cajas, names):
     """
-    for index, row in segments_df.iterrows():
-        avg_car_count = (
-            sum(row["car_count_per_frame"]) / len(row["car_count_per_frame"])
-            if row["car_count_per_frame"]
-            else 0
+    Writes the detections to a cache file, merging them with the frames that
+    were already stored.
+    """
+    anterior = cargar_cache_detecciones(cache_path)
+    if anterior is not None:
+        # Keep the old frames that were not inferred again
+        keep = ~np.isin(anterior["box_frame"], cajas["inferred"])
+        cajas = {
+            "inferred": np.union1d(anterior["inferred"], cajas["inferred"]),
+            **{
+                key: np.concatenate([anterior[key][keep], cajas[key]])
+                for key in ("box_frame", "box_class", "box_conf", "box_xyxy")
+            },
+        }
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path + ".tmp.npz"
+    np.savez_compressed(tmp_path, names=np.array(names, dtype=str), **cajas)
+    os.replace(tmp_path, cache_path)
+
+
+def _contar_clase(cajas, names, frames, label):
+    """
+    Number of boxes of one class in each of the given inferred frames.
+    """
+    if label not in names:
+        return np.zeros(len(frames), dtype=np.int16)
+    mask = (cajas["box_class"] == list(names).index(label)) & np.isin(
+        cajas["box_frame"], frames
+    )
+    positions = np.searchsorted(frames, cajas["box_frame"][mask])
+    return np.bincount(positions, minlength=len(frames)).astype(np.int16)
+
+
+def inferir_lotes(
+    model,
+    frames,
+    confidence,
+    batch_size,
+    stats,
+    pipelined=True,
+    queue_size=32,
+    cola_anotacion=None,
+):
+    """
+    Runs YOLO in batches over an iterable of (frame index, frame) and returns
+    the boxes of every frame.
+
+    With pipelined=True the iterable is consumed in a background thread, so
+    decoding and inference overlap. The statistics of both stages are added
+    to stats as "decode" and "inference". When cola_anotacion is given every
+    (frame, result) is put in it after inference.
+    """
+    stats["decode"] = _nueva_etapa()
+    stats["inference"] = _nueva_etapa()
+    if pipelined:
+        frames = _hilo_productor(frames, stats["decode"], queue_size)
+    else:
+        frames = _medir_etapa(frames, stats["decode"])
+
+    batch = []  # Decoded frames waiting for the next model call
+    batch_idx = []  # Their frame indices
+    partes = {key: [] for key in _cajas_vacias()}
+
+    def flush():
+        if not batch:
+            return
+        t0 = time.perf_counter()
+        results = model(batch, verbose=False, conf=confidence)
+        for frame_idx, result in zip(batch_idx, results):
+            boxes = result.boxes
+            partes["box_frame"].append(np.full(len(boxes), frame_idx, np.int32))
+            partes["box_class"].append(np.asarray(boxes.cls, np.int16).ravel())
+            partes["box_conf"].append(np.asarray(boxes.conf, np.float32).ravel())
+            partes["box_xyxy"].append(np.asarray(boxes.xyxy, np.float32).reshape(-1, 4))
+        partes["inferred"].append(np.asarray(batch_idx, np.int32))
+        stats["inference"]["seconds"] += time.perf_counter() - t0
+        stats["inference"]["frames"] += len(batch)
+
+        if cola_anotacion is not None:
+            for frame, result in zip(batch, results):
+                cola_anotacion.put((frame, result))
+        batch.clear()
+        batch_idx.clear()
+
+    try:
+        for frame_idx, frame in frames:
+            batch.append(frame)
+            batch_idx.append(frame_idx)
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+    finally:
+        # Stops the producer thread when the model fails
+        frames.close()
+
+    cajas = _cajas_vacias()
+    for key, valores in partes.items():
+        if valores:
+            cajas[key] = np.concatenate(valores)
+    return cajas
+
+
+def nombres_modelo(model):
+    """
+    Returns the class names of a YOLO model as a list ordered by class id.
+    """
+    return [model.names[i] for i in sorted(model.names)]
+
+
+def _inferir_frames(
+    video_path,
+    needed,
+    model_name,
+    confidence,
+    batch_size,
+    pipelined,
+    queue_size,
+    annotated_output,
+    stats,
+):
+    """
+    Runs YOLO over the needed frames of the video and returns their boxes
+    together with the class names of the model.
+    """
+    model = YOLO(model_name)  # Load YOLO model
+    cap = cv2.VideoCapture(video_path)  # Open video file
+
+    writer = None
+    cola_anotacion = None
+    if annotated_output:
+        size = (
+            int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        )
+        writer = cv2.VideoWriter(
+            annotated_output,
+            cv2.VideoWriter_fourcc(*"mp4v"),
+            cap.get(cv2.CAP_PROP_FPS),
+            size,
         )
-        avg_person_count = (
-            sum(row["person_count_per_frame"]) / len(row["person_count_per_frame"])
-            if row["person_count_per_frame"]
-            else 0
+
+        def anotar(frame, results):
+            _dibujar_objetos(frame, results, model.names)
+            writer.write(frame)
+
+        stats["annotation"] = _nueva_etapa()
+        cola_anotacion, hilo_anotacion = _hilo_consumidor(
+            anotar, stats["annotation"], queue_size
+        )
+
+    cajas = inferir_lotes(
+        model,
+        _decodificar_frames(cap, needed),
+        confidence,
+        batch_size,
+        stats,
+        pipelined,
+        queue_size,
+        cola_anotacion,
+    )
+    cap.release()
+
+    if writer is not None:
+        cola_anotacion.put(None)
+        hilo_anotacion.join()
+        writer.release()
+
+    return cajas, nombres_modelo(model)
+
+
+def seleccionar_frames(total_frames, fps, segments_df, stride=1, candidates_only=False):
+    """
+    Decides which frames are analysed and which are inferred.
+
+    Returns:
+        - frame_segments (np.ndarray): Segment of every frame, -1 if none.
+        - analysed (np.ndarray): Mask of the frames that get counts.
+        - needed (np.ndarray): Mask of the frames that go through YOLO, every
+            stride-th analysed frame counted from the start of its segment,
+            so every segment has its own inferred frames.
+
+    Raises:
+        - ValueError: If stride or fps are not positive.
+    """
+    if stride <= 0:
+        raise ValueError(f"stride must be at least 1, not {stride}")
+    if not fps > 0:
+        raise ValueError(f"fps must be positive, not {fps}")
+
+    # Segment of every frame, computed once for the whole video
+    frame_indices = np.arange(total_frames)
+    frame_segments = asignar_segmentos(frame_indices / fps, segments_df)
+    if candidates_only:
+        candidates = segments_df["frenazo_count"].to_numpy() > 0
+    else:
+        candidates = np.ones(len(segments_df), dtype=bool)
+
+    analysed = frame_segments >= 0
+    analysed[analysed] = candidates[frame_segments[analysed]]
+
+    # First frame of the run of frames of every segment
+    starts = np.ones(total_frames, dtype=bool)
+    starts[1:] = frame_segments[1:] != frame_segments[:-1]
+    run_start = np.maximum.accumulate(np.where(starts, frame_indices, 0))
+    needed = analysed & ((frame_indices - run_start) % stride == 0)
+    return frame_segments, analysed, needed
+
+
+def buscar_cache_detecciones(cache_path, needed):
+    """
+    Loads the cached detections if they cover every needed frame, otherwise
+    returns None.
+    """
+    cajas = cargar_cache_detecciones(cache_path)
+    if cajas is None:
+        return None
+    if not np.isin(np.flatnonzero(needed), cajas["inferred"]).all():
+        return None
+    return cajas
+
+
+def construir_detecciones(cajas, names, frame_segments, analysed, needed):
+    """
+    Builds the per-frame detection table from the boxes of the inferred
+    frames. Every analysed frame takes the counts of the last inferred frame
+    at or before it in the same segment, and 0 if there is none.
+    """
+    # Counts of the inferred frames, sorted by frame
+    inferred = np.asarray(cajas["inferred"])
+    inferred = inferred[needed[inferred]]
+    car_inferred = _contar_clase(cajas, names, inferred, "car")
+    person_inferred = _contar_clase(cajas, names, inferred, "person")
+
+    frames = np.flatnonzero(analysed)
+    source = np.searchsorted(inferred, frames, side="right") - 1
+    valid = source >= 0
+    # Counts are not carried over from another segment
+    valid[valid] = (
+        frame_segments[inferred[source[valid]]] == frame_segments[frames[valid]]
+    )
+    car = np.zeros(len(frames), dtype=np.int16)
+    person = np.zeros(len(frames), dtype=np.int16)
+    car[valid] = car_inferred[source[valid]]
+    person[valid] = person_inferred[source[valid]]
+
+    # One compact row per analysed frame, scoring only needs this table
+    return pd.DataFrame(
+        {
+            "frame": frames.astype(np.int32),
+            "segment": frame_segments[frames].astype(np.int32),
+            "car": car,
+            "person": person,
+        }
+    )
+
+
+def detectar_objetos_yolo(
+    video_path,
+    segments_df,
+    confidence=0.3,
+    batch_size=8,
+    stride=1,
+    candidates_only=False,
+    pipelined=True,
+    queue_size=32,
+    annotated_output=None,
+    model_name="yolov8n.pt",
+    use_cache=True,
+):
+    """
+    Detects objects in the video using YOLO and counts the number of cars and persons.
+
+    Frames are sent to the model in batches of batch_size. With stride > 1 only
+    every stride-th frame is inferred and the frames in between reuse the last
+    counts. With candidates_only=True only the segments with at least one
+    frenazo are analysed.
+
+    Every frame is assigned to its segment once, from its timestamp. The
+    result is a DataFrame with one row per analysed frame: "frame" and
+    "segment" (int32) and the "car" and "person" counts (int16).
+
+    The boxes of every inferred frame are stored in a cache file keyed by the
+    video content, model_name and confidence. When the cache already has all
+    the frames that are needed, YOLO is not run nor the video decoded. The
+    cache is not read when annotated_output is given.
+
+    With pipelined=True the video is decoded in a separate thread that feeds
+    the inference through a queue of queue_size frames. Boxes are only drawn
+    when annotated_output is given, in a third thread that writes the
+    annotated frames to that video file.
+
+    The throughput and queue depth of every stage are printed and stored in
+    the attrs["pipeline_stats"] of the result, the overall frames/sec in
+    attrs["yolo_fps"].
+    """
+    start_time = time.perf_counter()
+
+    cap = cv2.VideoCapture(video_path)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))  # Get total number of frames
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+
+    frame_segments, analysed, needed = seleccionar_frames(
+        total_frames, fps, segments_df, stride, candidates_only
+    )
+
+    stats = {}
+    cache_path = ruta_cache(video_path, model_name, confidence) if use_cache else None
+    cajas = None
+    if cache_path and not annotated_output:
+        cajas = buscar_cache_detecciones(cache_path, needed)
+
+    if cajas is not None:
+        names = list(cajas["names"])
+        print(f"YOLO: detecciones leídas de {cache_path}")
+    else:
+        cajas, names = _inferir_frames(
+            video_path,
+            needed,
+            model_name,
+            confidence,
+            batch_size,
+            pipelined,
+            queue_size,
+            annotated_output,
+            stats,
         )
+        if cache_path:
+            guardar_cache_detecciones(cache_path, cajas, names)
+
+    detecciones = construir_detecciones(cajas, names, frame_segments, analysed, needed)
+    _informar_rendimiento(detecciones, stats, start_time)
+    return detecciones
 
-        segments_df.at[index, "car_count"] = avg_car_count
-        segments_df.at[index, "person_count"] = avg_person_count
 
-        segments_df.at[index, "score"] = (
-            row["frenazo_count"] * pesos["frenazo"]
-            + avg_car_count * pesos["car"]
-            + avg_person_count * pesos["person"]
+def _informar_rendimiento(detecciones, stats, start_time):
+    """
+    Prints the throughput of the detection and stores it in the attrs of the
+    detection table.
+    """
+    elapsed = time.perf_counter() - start_time
+    n_frames = len(detecciones)
+    detecciones.attrs["yolo_fps"] = n_frames / elapsed if elapsed > 0 else 0.0
+    detecciones.attrs["pipeline_stats"] = _resumir_etapas(stats)
+
+    print(f"YOLO: {n_frames} frames a {detecciones.attrs['yolo_fps']:.1f} frames/s")
+    for nombre, etapa in stats.items():
+        print(
+            f"  {nombre}: {etapa['fps']:.1f} frames/s, "
+            f"cola media {etapa['queue_mean']:.1f} (max {etapa['queue_max']})"
         )
+
+
+# Resumir las detecciones por segmento
+def resumir_detecciones(segments_df, detecciones):
+    """
+    Adds the average number of cars and persons per analysed frame of each
+    segment as the "car_count" and "person_count" columns.
+    """
+    ids = detecciones["segment"].to_numpy()
+    n_segments = len(segments_df)
+    n_frames = np.bincount(ids, minlength=n_segments)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for column, label in (("car_count", "car"), ("person_count", "person")):
+            sums = np.bincount(
+                ids, weights=detecciones[label].to_numpy(), minlength=n_segments
+            )
+            segments_df[column] = np.where(n_frames > 0, sums / n_frames, 0.0)
+    return segments_df
+
+
+# Calcular la puntuación final de cada segmento
+def calcular_puntuacion(
+    segments_df, pesos={"frenazo": 2, "car": 1, "person": 1.5}, *, detecciones=None
+):
+    """
+    Calculates the final score for each segment based on the number of frenazos, cars, and persons detected.
+
+    When detecciones is given the per-segment averages are recomputed from it,
+    so the same detections can be scored again with different pesos without
+    running YOLO. Segments without car or person counts score only their
+    frenazos.
+    """
+    if detecciones is not None:
+        segments_df = resumir_detecciones(segments_df, detecciones)
+    for column in ("car_count", "person_count"):
+        if column not in segments_df:
+            segments_df[column] = 0.0
+
+    segments_df["score"] = (
+        segments_df["frenazo_count"] * pesos["frenazo"]
+        + segments_df["car_count"] * pesos["car"]
+        + segments_df["person_count"] * pesos["person"]
+    )
     return segments_df
 
 
+def _dibujar_resumen(frame, segmento):
+    """
+    Draws the score and counts of a segment on the frame.
+    """
+    text_overlay = (
+        f'Score: {segmento["score"]:.1f}\n'
+        f'Frenazos: {segmento["frenazo_count"]}\n'
+        f'Coches promedio por frame: {segmento["car_count"]:.1f}\n'
+        f'Personas promedio por frame: {segmento["person_count"]:.1f}'
+    )
+
+    y0, dy = 30, 30
+    for i, line in enumerate(text_overlay.split("\n")):
+        y = y0 + i * dy
+        cv2.putText(
+            frame,
+            line,
+            (10, y),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.6,
+            (255, 255, 255),
+            2,
+            cv2.LINE_AA,
+        )
+
+
 # Generar el video final con Overlay
 def generar_video_resumido(
-    video_path, segments_df, output_path="video_resumido_top3.mp4", top_n=3
+    video_path,
+    segments_df,
+    output_path="video_resumido_top3.mp4",
+    top_n=3,
+    stream_copy=False,
 ):
     """
     Generates a summarized video composed of the top N segments of 5 seconds each.
+
+    The chosen segments are written in chronological order. With
+    stream_copy=True the segments are copied with ffmpeg without re-encoding
+    nor overlay, cutting at the keyframe before each start. Otherwise the
+    video is decoded in a single forward pass, without seeking, and the
+    overlay is drawn on the frames of each segment.
     """
     # Seleccionar los 3 mejores segmentos
-    top_segments = segments_df.sort_values(by="score", ascending=False).head(top_n)
+    top_segments = (
+        segments_df.sort_values(by="score", ascending=False)
+        .head(top_n)
+        .sort_values(by="start")
+    )
+
+    if stream_copy:
+        ranges = list(zip(top_segments["start"], top_segments["end"]))
+        ffmpegUtils.cutAndConcat(video_path, ranges, output_path)
+        return
 
     cap = cv2.VideoCapture(video_path)
     fps = cap.get(cv2.CAP_PROP_FPS)
@@ -183,38 +954,22 @@ def generar_video_resumido(
     fourcc = cv2.VideoWriter_fourcc(*"mp4v")
     out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
 
+    frame_idx = 0
     for _, segmento in top_segments.iterrows():
-        start_frame = int(segmento["start"] * fps)
+        start_frame = max(int(segmento["start"] * fps), frame_idx)
         end_frame = int(segmento["end"] * fps)
 
-        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        # Frames before the segment are only grabbed, never converted
+        while frame_idx < start_frame and cap.grab():
+            frame_idx += 1
 
-        for _ in range(start_frame, end_frame):
+        while frame_idx < end_frame:
             ret, frame = cap.read()
             if not ret:
                 break
+            frame_idx += 1
 
-            text_overlay = (
-                f'Score: {segmento["score"]:.1f}\n'
-                f'Frenazos: {segmento["frenazo_count"]}\n'
-                f'Coches promedio por frame: {segmento["car_count"]:.1f}\n'
-                f'Personas promedio por frame: {segmento["person_count"]:.1f}'
-            )
-
-            y0, dy = 30, 30
-            for i, line in enumerate(text_overlay.split("\n")):
-                y = y0 + i * dy
-                cv2.putText(
-                    frame,
-                    line,
-                    (10, y),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    0.6,
-                    (255, 255, 255),
-                    2,
-                    cv2.LINE_AA,
-                )
-
+            _dibujar_resumen(frame, segmento)
             out.write(frame)
 
     cap.release()
@@ -228,8 +983,8 @@ if __name__ == "__main__":
     thresholds = calcular_umbrales(data)
     frenazos = detectar_frenazos(data, thresholds)
     segments_df = segmentar_video(data, frenazos)
-    segments_df = detectar_objetos_yolo(video_path, segments_df)
-    segments_df = calcular_puntuacion(segments_df)
+    detecciones = detectar_objetos_yolo(video_path, segments_df)
+    segments_df = calcular_puntuacion(segments_df, detecciones=detecciones)
     generar_video_resumido(
         video_path, segments_df, output_path="video_resumido_top3.mp4", top_n=3
     )
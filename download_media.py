@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+from logger import Logger
+import fileHandling
+
+
+def media_files_from_cameras(camera_paths, logger=None):
+    """
+    Generate the video and GCSV files of the given camera mount paths.
+
+    Every mounted camera is scanned once with fileHandling.scan_media. The
+    directory listing is cached per device serial, so the folders that did
+    not change since the last plug-in are not read again.
+
+    Args:
+        camera_paths (list of str): A list of paths where cameras are mounted.
+        logger (logging.Logger): Logger for the cameras that are not mounted.
+
+    Yields:
+        tuple: A tuple containing the following elements:
+            - cam_path (str): The path where the camera is mounted.
+            - full_path (str): The full path to the file.
+            - filename (str): The name of the file.
+            - kind (str): "video" or "gcsv".
+    """
+    for camera_path in camera_paths:
+        if not os.path.ismount(camera_path):
+            if logger:
+                logger.warning(f"Camera is not mounted at {camera_path}. Skipping.")
+            continue
+        serial = fileHandling.device_serial(camera_path)
+        listing = fileHandling.load_listing(serial)
+        media = fileHandling.scan_media(camera_path, listing)
+        fileHandling.save_listing(serial, listing)
+        yield from media
+
+
+def pair_by_stem(media):
+    """
+    Pair every video with the GCSV file that has the same name.
+
+    Args:
+        media (iterable): Tuples from media_files_from_cameras.
+
+    Returns:
+        tuple: A tuple containing the following elements:
+            - pairs (list): (video, gcsv) tuples of the files with a match.
+            - unpaired (list): The files without a match.
+    """
+    by_stem = {}
+    for item in media:
+        stem = os.path.join(item[0], os.path.splitext(item[2])[0])
+        by_stem.setdefault(stem, {})[item[3]] = item
+
+    pairs = []
+    unpaired = []
+    for files in by_stem.values():
+        if "video" in files and "gcsv" in files:
+            pairs.append((files["video"], files["gcsv"]))
+        else:
+            unpaired.extend(files.values())
+    return pairs, unpaired
+
+
+def run(camera_paths, video_path, gcsv_path):
+
+    global logger
+
+    # Create the destination folders if they don't exist
+    os.makedirs(video_path, exist_ok=True)
+    os.makedirs(gcsv_path, exist_ok=True)
+
+    # Define camera mount paths
+    log_file = os.path.join(video_path, "download_log.txt")
+
+    # Configure the logger
+    logger = Logger(name="DownloadMediaLogger", log_file=log_file).get_logger()
+    destinations = {"video": video_path, "gcsv": gcsv_path}
+
+    pairs, unpaired = pair_by_stem(media_files_from_cameras(camera_paths, logger))
+    for cam_path, source, filename, kind in unpaired:
+        logger.warning(
+            f"No matching {'GCSV' if kind == 'video' else 'video'} for {source}"
+        )
+
+    # One shared engine with a copy queue per camera. The small GCSV file of
+    # every pair is queued before its video so it is available first.
+    with fileHandling.CopyEngine(logger=logger) as engine:
+        for video, gcsv in pairs:
+            for cam_path, source, filename, kind in (gcsv, video):
+                engine.submit((cam_path, source, filename, destinations[kind]))
+        for cam_path, source, filename, kind in unpaired:
+            engine.submit((cam_path, source, filename, destinations[kind]))
+    return engine.stats
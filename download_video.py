@@ -2,18 +2,22 @@
 # -*- coding: utf-8 -*-
 
 import os
-from concurrent.futures import ThreadPoolExecutor
 from logger import Logger
 import fileHandling
+import download_media
+
+
+# Configured by run
+logger = None
 
 
 def video_files_from_cameras(camera_paths):
     """
     Generate video file paths from the given camera mount paths.
 
-    This function iterates over the provided camera mount paths, checks if each path is mounted,
-    and then walks through the directory structure to find video files. It yields tuples containing
-    the camera path, the full path to the video file, and the filename.
+    The cameras are scanned with download_media.media_files_from_cameras, which reads every
+    directory once for both kinds of files, and only the video files are yielded. It yields
+    tuples containing the camera path, the full path to the file, and the filename.
 
     Args:
         camera_paths (list of str): A list of paths where cameras are mounted.
@@ -24,17 +28,11 @@ def video_files_from_cameras(camera_paths):
             - full_path (str): The full path to the video file.
             - filename (str): The name of the video file.
     """
-    for camera_path in camera_paths:
-        if not os.path.ismount(camera_path):
-            logger.warning(f"Camera is not mounted at {camera_path}. Skipping.")
-            continue
-        for root, dirs, files in os.walk(camera_path):
-            # Skip directories that start with .Trash
-            dirs[:] = [d for d in dirs if not d.startswith(".Trash")]
-
-            for filename in files:
-                if fileHandling.is_video(filename):
-                    yield camera_path, os.path.join(root, filename), filename
+    for cam_path, full_path, filename, kind in download_media.media_files_from_cameras(
+        camera_paths, logger
+    ):
+        if kind == "video":
+            yield cam_path, full_path, filename
 
 
 def run(camera_paths, destination_path):
@@ -50,12 +48,7 @@ def run(camera_paths, destination_path):
     # Create the destination folder if it doesn't exist
     os.makedirs(destination_path, exist_ok=True)
 
-    # Use ThreadPoolExecutor with executor.map to process files as they are generated
-    with ThreadPoolExecutor() as executor:
-        # Create a generator expression for tasks to be processed by the executor
-        tasks_iterable = (
-            (cam_path, source, filename, destination_path)
-            for cam_path, source, filename in video_files_from_cameras(camera_paths)
-        )
-        # executor.map will handle the iterable lazily and process files as they are generated
-        list(executor.map(fileHandling.process_file, tasks_iterable))
+    # One copy queue per camera, so the cards are read sequentially
+    with fileHandling.CopyEngine(logger=logger) as engine:
+        for cam_path, source, filename in video_files_from_cameras(camera_paths):
+            engine.submit((cam_path, source, filename, destination_path))
@@ -0,0 +1,238 @@
+import os
+import subprocess
+import tempfile
+
+
+def runFFmpeg(args: list) -> None:
+    """
+    Run ffmpeg with the given arguments, raising an error if it fails.
+
+    Args:
+        - args (list): Arguments for ffmpeg, without the executable name.
+
+    Returns:
+        - None
+    """
+    command = ["ffmpeg", "-hide_banner", "-v", "error", "-y"] + args
+    result = subprocess.run(command, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr}")
+
+
+def _quote(path: str) -> str:
+    """
+    Quote a path for an ffmpeg concat list file.
+    """
+    return "'" + os.path.abspath(path).replace("'", "'\\''") + "'"
+
+
+def getKeyframeTimes(inputFile: str) -> list:
+    """
+    Get the time in seconds of every keyframe of the first video stream,
+    relative to its first packet. Only packets are read, nothing is decoded.
+
+    Args:
+        - inputFile (str): Path of the video.
+
+    Returns:
+        - times (list): Sorted keyframe times.
+    """
+    command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=p=0",
+        inputFile,
+    ]
+    result = subprocess.run(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed: {result.stderr}")
+
+    times = []
+    first = None
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        try:
+            pts_time = float(pts_time)
+        except ValueError:
+            continue
+        first = pts_time if first is None else min(first, pts_time)
+        if "K" in flags:
+            times.append(pts_time)
+
+    return sorted(time - first for time in times)
+
+
+def concatFiles(inputFiles: list, outputFile: str, audioSource: str = None) -> None:
+    """
+    Join several files with the same codecs into one without re-encoding.
+
+    Args:
+        - inputFiles (list): Paths of the files, in order.
+        - outputFile (str): Path of the joined file.
+        - audioSource (str, optional): File whose audio track replaces the
+            audio of the joined files.
+
+    Returns:
+        - None
+    """
+    lines = [f"file {_quote(path)}" for path in inputFiles]
+    _concat(lines, outputFile, audioSource)
+
+
+def cutAndConcat(inputFile: str, ranges: list, outputFile: str) -> None:
+    """
+    Copy several time ranges of a video into one file without re-encoding.
+
+    The streams are copied, so every range starts at the keyframe at or
+    before its start time.
+
+    Args:
+        - inputFile (str): Path of the source video.
+        - ranges (list): (start, end) tuples in seconds, in output order.
+        - outputFile (str): Path of the output video.
+
+    Returns:
+        - None
+    """
+    lines = []
+    for start, end in ranges:
+        lines.append(f"file {_quote(inputFile)}")
+        lines.append(f"inpoint {start:.6f}")
+        lines.append(f"outpoint {end:.6f}")
+    _concat(lines, outputFile)
+
+
+def _concat(lines: list, outputFile: str, audioSource: str = None) -> None:
+    """
+    Run the ffmpeg concat demuxer over the given list file lines.
+    """
+    with tempfile.NamedTemporaryFile(
+        "w", suffix=".txt", delete=False, encoding="utf-8"
+    ) as listFile:
+        listFile.write("\n".join(lines) + "\n")
+
+    args = ["-f", "concat", "-safe", "0", "-i", listFile.name]
+    if audioSource:
+        args += ["-i", audioSource, "-map", "0:v", "-map", "1:a?", "-shortest"]
+    else:
+        args += ["-map", "0"]
+    args += ["-c", "copy", outputFile]
+
+    try:
+        runFFmpeg(args)
+    finally:
+        os.remove(listFile.name)
+
+
+class FFmpegWriter:
+    """
+    Video writer that streams raw BGR frames to an ffmpeg process.
+
+    It has the same write/isOpened/release methods as cv2.VideoWriter, so it
+    can be used in its place. The frames are encoded with libx264 and the
+    audio of audioSource, if any, is copied without re-encoding.
+    """
+
+    def __init__(
+        self,
+        outputFile: str,
+        width: int,
+        height: int,
+        fps: float,
+        audioSource: str = None,
+        preset: str = "veryfast",
+        crf: int = 23,
+        threads: int = 0,
+        codec: str = "libx264",
+    ):
+        """
+        Args:
+            outputFile (str): Path of the output video.
+            width (int): Width of the frames.
+            height (int): Height of the frames.
+            fps (float): Frame rate of the output, usually the source one.
+            audioSource (str, optional): Video whose audio track is copied.
+            preset (str): x264 preset, from "ultrafast" to "veryslow".
+            crf (int): x264 constant rate factor, lower is better quality.
+            threads (int): Encoder threads, 0 lets ffmpeg decide.
+            codec (str): Video encoder passed to ffmpeg.
+        """
+        self.outputFile = outputFile
+        command = [
+            "ffmpeg",
+            "-hide_banner",
+            "-v",
+            "error",
+            "-y",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "bgr24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            f"{fps:.6f}",
+            "-i",
+            "-",
+        ]
+        if audioSource:
+            command += ["-i", audioSource, "-map", "0:v", "-map", "1:a?"]
+            command += ["-c:a", "copy", "-shortest"]
+        command += [
+            "-c:v",
+            codec,
+            "-preset",
+            preset,
+            "-crf",
+            str(crf),
+            "-threads",
+            str(threads),
+            "-pix_fmt",
+            "yuv420p",
+            outputFile,
+        ]
+
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.process = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stderr=self.stderr
+            )
+        except OSError:
+            self.process = None
+
+    def isOpened(self) -> bool:
+        """
+        Check if the ffmpeg process is running.
+        """
+        return self.process is not None and self.process.poll() is None
+
+    def write(self, frame) -> None:
+        """
+        Send one BGR frame to ffmpeg.
+        """
+        if not frame.flags.c_contiguous:
+            frame = frame.copy()
+        self.process.stdin.write(frame.data)
+
+    def release(self) -> None:
+        """
+        Finish the video and wait for ffmpeg to exit.
+        """
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        self.stderr.seek(0)
+        error = self.stderr.read().decode(errors="replace")
+        self.stderr.close()
+        self.process = None
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {error}")
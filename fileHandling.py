@@ -1,13 +1,32 @@
 import os
+import json
+import getpass
+import time
+import hashlib
+import queue
 import shutil
+import threading
+import config
 from logger import Logger
 
 
-def getConnectedDevices() -> list:
+def getMediaFolder() -> str:
+    """
+    This function returns the folder where the devices of the user are mounted.
+    """
+    try:
+        user = os.getlogin()
+    except OSError:
+        # No controlling terminal, e.g. when running as a service
+        user = getpass.getuser()
+    return os.path.join("/media", user)
+
+
+def getConnectedDevices(deviceFolder: str = None) -> list:
     """
     This function returns a list of connected devices.
     """
-    deviceFolder = os.path.join("/media", os.getlogin())
+    deviceFolder = deviceFolder or getMediaFolder()
     devices = []
     if os.path.exists(deviceFolder):
         devices = [
@@ -60,19 +79,380 @@ def is_gcsv(filename: str) -> bool:
     return isExtension(filename, valid_extensions)
 
 
-def process_file(task: tuple, logger=None) -> None:
+def device_serial(cam_path: str) -> str:
+    """
+    Identifier of the device mounted at cam_path.
+
+    The filesystem UUID (the volume serial of FAT/exFAT cards) is looked up in
+    /dev/disk/by-uuid. When it cannot be found the name of the mount folder,
+    which is the serial for cards mounted without a label, is used.
+    """
+    cam_path = os.path.abspath(cam_path)
+    try:
+        with open("/proc/mounts") as f:
+            mounts = [line.split() for line in f]
+        source = next(
+            fields[0]
+            for fields in mounts
+            if fields[1].replace("\\040", " ") == cam_path
+        )
+        by_uuid = "/dev/disk/by-uuid"
+        for uuid in os.listdir(by_uuid):
+            if os.path.realpath(os.path.join(by_uuid, uuid)) == os.path.realpath(
+                source
+            ):
+                return uuid
+    except (OSError, StopIteration):
+        pass
+    return os.path.basename(os.path.normpath(cam_path)) or "root"
+
+
+def _listing_path(serial: str) -> str:
+    return os.path.join(config.getCacheFolder(), "listings", f"{serial}.json")
+
+
+def load_listing(serial: str) -> dict:
+    """
+    Load the cached directory listing of a device, see scan_media.
+    """
+    try:
+        with open(_listing_path(serial)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_listing(serial: str, listing: dict) -> None:
+    """
+    Store the directory listing of a device for the next scan.
+    """
+    path = _listing_path(serial)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(listing, f)
+    os.replace(tmp_path, path)
+
+
+def scan_media(camera_path: str, listing: dict = None) -> list:
+    """
+    Find the video and GCSV files of a device in a single pass.
+
+    Every directory is read once with os.scandir and its entries are
+    classified with is_video and is_gcsv. Directories that start with .Trash
+    are skipped. With a listing from a previous scan, the subtrees that had
+    no media and whose modification time did not change are not read again.
+    The directories with media and the ones above them are always read:
+    camera firmware writing FAT/exFAT cards does not update the modification
+    time of a directory when it creates a file in it. The listing is updated
+    in place.
+
+    Args:
+        - camera_path (str): The path where the camera is mounted.
+        - listing (dict): Cached listing of the device, see load_listing.
+
+    Returns:
+        - media (list): (cam_path, full_path, filename, kind) tuples, kind
+            being "video" or "gcsv".
+    """
+    cached = listing.get("dirs", {}) if listing is not None else {}
+    scanned = {}
+    media = []
+
+    # Directories that had media, and every directory above them
+    with_media = set()
+    for relative, entry in cached.items():
+        if entry["files"]:
+            while relative not in with_media:
+                with_media.add(relative)
+                relative = os.path.dirname(relative)
+
+    pending = [""]
+    while pending:
+        relative = pending.pop()
+        folder = os.path.join(camera_path, relative)
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            continue
+
+        entry = cached.get(relative)
+        if entry is None or entry["mtime"] != mtime or relative in with_media:
+            entry = {"mtime": mtime, "files": [], "dirs": []}
+            try:
+                with os.scandir(folder) as entries:
+                    for item in entries:
+                        if item.is_dir(follow_symlinks=False):
+                            if not item.name.startswith(".Trash"):
+                                entry["dirs"].append(item.name)
+                        elif is_video(item.name):
+                            entry["files"].append([item.name, "video"])
+                        elif is_gcsv(item.name):
+                            entry["files"].append([item.name, "gcsv"])
+            except OSError:
+                continue
+
+        scanned[relative] = entry
+        for filename, kind in entry["files"]:
+            media.append((camera_path, os.path.join(folder, filename), filename, kind))
+        pending.extend(os.path.join(relative, name) for name in entry["dirs"])
+
+    if listing is not None:
+        listing["dirs"] = scanned
+    return media
+
+
+COPY_BUFFER_SIZE = 8 * 1024 * 1024  # Bytes moved per system call
+
+
+def _copy_data(fsrc, fdst, buffer_size: int) -> int:
+    """
+    Copy everything from one open binary file to another.
+
+    The kernel copies the data with os.copy_file_range, or os.sendfile when
+    the filesystems do not support it. A plain loop with a big buffer is the
+    last fallback.
+
+    Returns:
+        - copied (int): Number of bytes written.
+    """
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    copied = 0
+
+    # The kernel uses the descriptor offsets, which a buffered seek inside
+    # the read buffer does not move
+    fdst.flush()
+    os.lseek(infd, fsrc.tell(), os.SEEK_SET)
+    os.lseek(outfd, fdst.tell(), os.SEEK_SET)
+
+    for kernel_copy in ("copy_file_range", "sendfile"):
+        if not hasattr(os, kernel_copy):
+            continue
+        try:
+            while True:
+                if kernel_copy == "copy_file_range":
+                    sent = os.copy_file_range(infd, outfd, buffer_size)
+                else:
+                    sent = os.sendfile(outfd, infd, None, buffer_size)
+                if sent == 0:
+                    return copied
+                copied += sent
+        except OSError:
+            if copied:
+                raise
+            # Not supported between these files, try the next method
+
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        n = fsrc.readinto(buffer)
+        if not n:
+            return copied
+        fdst.write(view[:n])
+        copied += n
+
+
+def file_checksum(path: str, buffer_size: int = COPY_BUFFER_SIZE) -> str:
+    """
+    BLAKE2b checksum of a file, read in chunks of buffer_size bytes.
+    """
+    hasher = hashlib.blake2b()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while n := f.readinto(buffer):
+            hasher.update(view[:n])
+    return hasher.hexdigest()
+
+
+def _same_prefix(fsrc, fdst, length: int, buffer_size: int, hasher=None) -> bool:
+    """
+    Compare the first length bytes of two open binary files, adding the ones
+    of fsrc to hasher. Stops at the first difference.
+    """
+    fsrc.seek(0)
+    fdst.seek(0)
+    remaining = length
+    while remaining:
+        chunk = min(buffer_size, remaining)
+        data = fsrc.read(chunk)
+        if len(data) != chunk or fdst.read(chunk) != data:
+            return False
+        if hasher is not None:
+            hasher.update(data)
+        remaining -= chunk
+    return True
+
+
+def copy_file(
+    source: str,
+    destination: str,
+    buffer_size: int = COPY_BUFFER_SIZE,
+    resume: bool = True,
+    checksum: bool = True,
+) -> tuple:
+    """
+    Copy a file with its metadata, like shutil.copy2, moving the data in
+    large sequential chunks.
+
+    The data is written to "<destination>.part", which is renamed to the
+    destination only once it is complete, so an interrupted copy never
+    leaves a truncated file under the final name. With resume=True an
+    existing ".part" file is continued from its size instead of copied
+    again, once its data has been compared with the start of the source. A
+    ".part" file that differs is copied again from the start.
+
+    With checksum=True the data goes through Python so its BLAKE2b is
+    computed from the bytes read from the source. This is what lets
+    process_file verify the
+    copy against the source, at the cost of the kernel copy. With
+    checksum=False the kernel copies the data, see _copy_data, and no
+    checksum is computed.
+
+    Args:
+        - source (str): Path of the file to copy.
+        - destination (str): Path of the new file.
+        - buffer_size (int): Bytes moved per call.
+        - resume (bool): Continue a previous partial copy.
+        - checksum (bool): Compute the checksum of the copied file.
+
+    Returns:
+        - copied (int): Number of bytes copied in this call.
+        - digest (str): BLAKE2b of the whole file, None without checksum.
+    """
+    part = destination + ".part"
+    size = os.path.getsize(source)
+    offset = os.path.getsize(part) if resume and os.path.exists(part) else 0
+    if offset > size:
+        offset = 0
+
+    hasher = hashlib.blake2b() if checksum else None
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+
+    with open(source, "rb") as fsrc, open(part, "r+b" if offset else "wb") as fdst:
+        if offset and not _same_prefix(fsrc, fdst, offset, buffer_size, hasher):
+            # Not a prefix of this source, start over
+            offset = 0
+            hasher = hashlib.blake2b() if checksum else None
+        fdst.seek(offset)
+        fdst.truncate()
+        fsrc.seek(offset)
+
+        if hasher is None:
+            copied = _copy_data(fsrc, fdst, buffer_size)
+        else:
+            copied = 0
+            while n := fsrc.readinto(buffer):
+                hasher.update(view[:n])
+                fdst.write(view[:n])
+                copied += n
+        fdst.flush()
+        os.fsync(fdst.fileno())
+
+    if os.path.getsize(part) != size:
+        raise OSError(
+            f"Incomplete copy of {source}: {os.path.getsize(part)} of {size} bytes"
+        )
+
+    shutil.copystat(source, part)
+    os.replace(part, destination)
+    return copied, hasher.hexdigest() if hasher is not None else None
+
+
+class TransferManifest:
+    """
+    Record of the files already transferred from a device to a folder.
+
+    The manifest is a JSON file with one entry per source file (relative to
+    the mount path) holding its size, modification time and, once it has been
+    copied, the BLAKE2b of the copy. A file whose entry matches the source is
+    skipped without reading it, so re-plugging a card copies nothing.
+    """
+
+    def __init__(self, path: str, device: str = None):
+        """
+        Args:
+            path (str): Path of the JSON file, created on the first record.
+            device (str): Name of the device, as in allowed_devices.
+        """
+        self.path = path
+        self.device = device
+        self.lock = threading.Lock()
+        self.files = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    manifest = json.load(f)
+                self.files = manifest["files"]
+                self.device = device or manifest.get("device")
+            except (ValueError, KeyError):
+                self.files = {}
+
+    @classmethod
+    def for_device(cls, destination_path: str, cam_path: str):
+        """
+        Manifest of the files copied from the device mounted at cam_path
+        to destination_path. It is kept in a ".transfers" folder inside the
+        destination, named after the serial of the device, and also keeps the
+        name of the mount folder.
+        """
+        serial = device_serial(cam_path)
+        return cls(
+            os.path.join(destination_path, ".transfers", f"{serial}.json"),
+            os.path.basename(os.path.normpath(cam_path)),
+        )
+
+    def get(self, key: str) -> dict:
+        with self.lock:
+            return self.files.get(key)
+
+    def record(self, key: str, entry: dict) -> None:
+        """
+        Store the entry of a file and write the manifest to disk.
+        """
+        with self.lock:
+            self.files[key] = entry
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Write to a temporary file first so a crash never leaves a broken manifest
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"device": self.device, "files": self.files}, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+
+def process_file(task: tuple, logger=None, manifest=None, verify: bool = True) -> int:
     """
     Process a single file download task.
 
+    The copy is skipped when the manifest of the device says that the file
+    was already transferred and the destination still has its size. The
+    copy is written to a temporary ".part" file and renamed when complete,
+    see copy_file. A ".part" file is only resumed when the manifest of this
+    device recorded the copy as started from the same source, so the data
+    of another device is never taken as a prefix.
+
+    A destination with the same name and another size that this device did
+    not copy, or a ".part" file of another device, is a name conflict: the
+    file is skipped and the conflict is logged.
+
     Args:
         task (tuple): A tuple containing the following elements:
             - cam_path (str): The path where the camera is mounted.
             - source (str): The full path to the source video file.
             - filename (str): The name of the video file.
             - destination_path (str): The path to the destination directory where the file should be copied.
+        logger (logging.Logger): Logger for the copies.
+        manifest (TransferManifest): Manifest of the device. Defaults to the
+            one in the destination folder, see TransferManifest.for_device.
+        verify (bool): Compute the checksum from the source while copying
+            and compare it with the copy read again. Without it the kernel
+            copies the data, which is faster, and the checksum recorded in
+            the manifest is taken from the copy afterwards, so it does not
+            detect a bad copy.
 
     Returns:
-        - None
+        - copied (int): Number of bytes copied, 0 if the file was skipped.
     """
     cam_path, source, filename, destination_path = task
     destination = os.path.join(destination_path, filename)
@@ -89,11 +469,195 @@ def process_file(task: tuple, logger=None) -> None:
     if isinstance(destination, bytes):
         destination = destination.decode("utf-8")
 
+    if manifest is None:
+        manifest = TransferManifest.for_device(destination_path, cam_path)
+    key = os.path.relpath(source, os.fspath(cam_path))
+    stat = os.stat(source)
+    entry = manifest.get(key)
+    same_source = (
+        entry is not None
+        and entry["size"] == stat.st_size
+        and entry["mtime"] == stat.st_mtime
+    )
+
     # Check if the file already exists at the destination
-    if not os.path.exists(destination):
-        shutil.copy2(source, destination)
+    if os.path.exists(destination):
+        if os.path.getsize(destination) == stat.st_size:
+            if not (same_source and entry.get("blake2b")):
+                # Copied before the manifest existed, record it
+                manifest.record(
+                    key,
+                    {
+                        "size": stat.st_size,
+                        "mtime": stat.st_mtime,
+                        "blake2b": file_checksum(destination),
+                        "destination": destination,
+                    },
+                )
+            if logger:
+                logger.warning(f"File already exists: {filename}. Skipping download.")
+            return 0
+        # Copies are renamed only when complete, so this file is not ours
         if logger:
-            logger.info(f"Downloaded from {cam_path}: {filename}")
-    else:
-        if logger:
-            logger.warning(f"File already exists: {filename}. Skipping download.")
+            logger.error(
+                f"Name conflict: {destination} exists with another size "
+                f"than {source}. Skipping download."
+            )
+        return 0
+
+    part = destination + ".part"
+    # Started by this device from the same source and not finished
+    in_flight = same_source and not entry.get("blake2b")
+    if os.path.exists(part) and not in_flight:
+        if entry is None:
+            # Left by a copy from another device, which may still be running
+            if logger:
+                logger.error(
+                    f"Name conflict: {part} was not started from {source}. "
+                    "Skipping download."
+                )
+            return 0
+        # The partial copy belongs to an older version of the source
+        os.remove(part)
+    elif in_flight and os.path.exists(part) and logger:
+        logger.warning(f"Resuming interrupted copy of {filename}")
+
+    manifest.record(key, {"size": stat.st_size, "mtime": stat.st_mtime})
+    copied, digest = copy_file(source, destination, resume=in_flight, checksum=verify)
+    if not verify:
+        # Read from the local disk, mostly from the page cache
+        digest = file_checksum(destination)
+    elif file_checksum(destination) != digest:
+        os.remove(destination)
+        raise OSError(f"Checksum mismatch after copying {source}")
+
+    manifest.record(
+        key,
+        {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "blake2b": digest,
+            "destination": destination,
+        },
+    )
+    if logger:
+        logger.info(f"Downloaded from {cam_path}: {filename}")
+    return copied
+
+
+class CopyEngine:
+    """
+    Copies files with a separate queue for every device.
+
+    Reading several big files at once from the same card makes it seek
+    between them, so every device gets only streams_per_device copies at a
+    time while different devices are copied in parallel. The throughput of
+    every device is measured and logged when the engine is closed.
+
+    Usage:
+        with CopyEngine(logger=logger) as engine:
+            for task in tasks:
+                engine.submit(task)
+        print(engine.stats)
+    """
+
+    def __init__(self, streams_per_device: int = 1, logger=None, verify: bool = None):
+        """
+        Args:
+            streams_per_device (int): Files copied at the same time from one
+                device.
+            logger (logging.Logger): Logger for the copies and the throughput.
+            verify (bool): Verify every copy against its source, see
+                process_file. Defaults to "verify_copies" in the
+                configuration, True if it is not set. False uses the kernel
+                copy.
+        """
+        self.streams_per_device = streams_per_device
+        self.logger = logger
+        if verify is None:
+            verify = config.getConfiguration().get("verify_copies", True)
+        self.verify = verify
+        self.manifests = {}
+        self.queues = {}
+        self.threads = []
+        self.errors = []  # (task, exception) of every file that was not copied
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def submit(self, task: tuple) -> None:
+        """
+        Queue a download task, see process_file. The first element of the
+        task, the mount path of the camera, picks the device queue.
+        """
+        device = task[0]
+        manifest_key = (device, task[3])
+        if manifest_key not in self.manifests:
+            self.manifests[manifest_key] = TransferManifest.for_device(task[3], device)
+        if device not in self.queues:
+            self.queues[device] = queue.Queue()
+            self.stats[device] = {"files": 0, "bytes": 0, "start": None, "end": None}
+            for _ in range(self.streams_per_device):
+                thread = threading.Thread(
+                    target=self._worker, args=(device,), daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+        self.queues[device].put(task)
+
+    def _worker(self, device: str) -> None:
+        tasks = self.queues[device]
+        stats = self.stats[device]
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            start = time.perf_counter()
+            try:
+                manifest = self.manifests[(device, task[3])]
+                copied = process_file(task, self.logger, manifest, self.verify)
+            except Exception as error:
+                # Any failure only fails this file, the thread keeps copying the
+                # rest of the queue of the device
+                self.errors.append((task, error))
+                if self.logger and isinstance(error, OSError):
+                    self.logger.error(f"Could not copy {task[1]}: {error}")
+                elif self.logger:
+                    self.logger.exception(f"Could not copy {task[1]}: {error!r}")
+                continue
+            with self.lock:
+                if stats["start"] is None:
+                    stats["start"] = start
+                stats["end"] = time.perf_counter()
+                stats["files"] += 1 if copied else 0
+                stats["bytes"] += copied
+
+    def close(self) -> dict:
+        """
+        Wait for every queued copy and log the throughput of every device.
+
+        Returns:
+            - stats (dict): For every device the "files" and "bytes" copied,
+                the "seconds" it was busy and the "mbps" (MB/s).
+        """
+        for device, tasks in self.queues.items():
+            for _ in range(self.streams_per_device):
+                tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        for device, stats in self.stats.items():
+            seconds = (stats.pop("end") or 0) - (stats.pop("start") or 0)
+            stats["seconds"] = seconds
+            stats["mbps"] = stats["bytes"] / seconds / 1e6 if seconds > 0 else 0.0
+            if self.logger:
+                self.logger.info(
+                    f"{device}: {stats['files']} files, "
+                    f"{stats['bytes'] / 1e6:.1f} MB at {stats['mbps']:.1f} MB/s"
+                )
+        return self.stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
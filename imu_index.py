@@ -0,0 +1,505 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import config
+import fileHandling
+import parallelism
+import sync
+import data_analysis
+
+
+CHANNELS = ["rx", "ry", "rz", "ax", "ay", "az"]
+LEVELS = (1, 10, 60)  # Seconds per bucket of every pyramid level
+EVENT_GAP = 0.5  # Brake samples closer than this (s) belong to the same event
+MANIFEST_FILE = "index.json"
+EVENTS_FILE = "events.csv"
+
+
+def _load_source(source_file: str):
+    """
+    Load the timestamps and the six sensor channels of a GCSV file or a
+    synchronized file in any of the sync.SAVERS formats.
+
+    Returns:
+        - t (np.ndarray): Timestamps in seconds.
+        - values (np.ndarray): Array of shape (n, 6) in CHANNELS order.
+    """
+    if fileHandling.is_gcsv(source_file):
+        data = sync.load_gcsv_file(source_file)
+        return np.asarray(data[:, 0]), np.asarray(data[:, 1:7])
+    data = data_analysis.cargar_csv(source_file)
+    return data["timestamp"].to_numpy(), data[CHANNELS].to_numpy(np.float64)
+
+
+def _is_source(filename: str) -> bool:
+    """
+    Check if a file is a recording to index: a GCSV file or a synchronized
+    file. The ".gcsv.npy" sidecars of sync.load_gcsv_file and the temporary
+    files of an unfinished write are not.
+    """
+    if fileHandling.is_gcsv(filename):
+        return True
+    name, extension = os.path.splitext(filename.lower())
+    if extension not in sync.SAVERS or ".tmp" in filename.lower():
+        return False
+    return not fileHandling.is_gcsv(name)
+
+
+def _aggregate(ids, count, minimum, maximum, total):
+    """
+    Merge consecutive rows that share the same bucket id.
+
+    Args:
+        - ids (np.ndarray): Sorted bucket id of every row.
+        - count, minimum, maximum, total (np.ndarray): Statistics of every
+            row, the last three of shape (n, 6).
+
+    Returns:
+        - level (dict): "start" bucket ids and the merged statistics.
+    """
+    bounds = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    return {
+        "start": ids[bounds],
+        "count": np.add.reduceat(count, bounds),
+        "min": np.minimum.reduceat(minimum, bounds),
+        "max": np.maximum.reduceat(maximum, bounds),
+        "sum": np.add.reduceat(total, bounds),
+    }
+
+
+def build_pyramid(t: np.ndarray, values: np.ndarray) -> dict:
+    """
+    Build the min/max/mean pyramid of a recording.
+
+    The finest level is computed from the samples and the coarser levels
+    from the finest one, so the samples are read once. Buckets without
+    samples are not stored.
+
+    Args:
+        - t (np.ndarray): Sorted timestamps in seconds.
+        - values (np.ndarray): Array of shape (n, 6) in CHANNELS order.
+
+    Returns:
+        - pyramid (dict): For every level in LEVELS a dict with the "start"
+            time (s, from the first sample), "count", "min", "max" and
+            "mean" arrays.
+    """
+    relative = t - t[0] if len(t) else t
+    ids = np.floor(relative / LEVELS[0]).astype(np.int64)
+    finest = _aggregate(ids, np.ones(len(t), np.int64), values, values, values)
+
+    pyramid = {}
+    for resolution in LEVELS:
+        # Coarser levels merge the buckets of the finest one
+        ratio = resolution // LEVELS[0]
+        level = _aggregate(
+            finest["start"] // ratio,
+            finest["count"],
+            finest["min"],
+            finest["max"],
+            finest["sum"],
+        )
+        pyramid[resolution] = {
+            "start": level["start"] * float(resolution),
+            "count": level["count"],
+            "min": level["min"],
+            "max": level["max"],
+            "mean": level["sum"] / level["count"][:, None],
+        }
+    return pyramid
+
+
+def find_events(t: np.ndarray, values: np.ndarray, thresholds: dict) -> dict:
+    """
+    Group the brake samples of a recording into events.
+
+    A sample is a brake with the rule of data_analysis.detectar_frenazos.
+    Brake samples closer than EVENT_GAP seconds form one event.
+
+    Returns:
+        - events (dict): "start" and "end" times (s, from the first sample)
+            and the minimum "ax", "ay" and "az" of every event.
+    """
+    acc = values[:, 3:6]
+    limits = np.array([thresholds[axis] for axis in data_analysis.EJES])
+    brake = np.flatnonzero((acc < limits).any(axis=1))
+    relative = t - t[0] if len(t) else t
+
+    if not len(brake):
+        events = {"start": np.zeros(0), "end": np.zeros(0)}
+        events.update({axis: np.zeros(0) for axis in data_analysis.EJES})
+        return events
+
+    times = relative[brake]
+    bounds = np.flatnonzero(np.r_[True, np.diff(times) > EVENT_GAP])
+    ends = np.r_[bounds[1:], len(brake)] - 1
+    events = {"start": times[bounds], "end": times[ends]}
+    minimums = np.minimum.reduceat(acc[brake], bounds)
+    for i, axis in enumerate(data_analysis.EJES):
+        events[axis] = minimums[:, i]
+    return events
+
+
+def _index_path(index_dir: str, name: str) -> str:
+    return os.path.join(index_dir, f"{name}.npz")
+
+
+def index_recording(source_file: str, index_file: str) -> None:
+    """
+    Build the pyramid and the events of one recording and write them to
+    index_file.
+
+    Args:
+        - source_file (str): GCSV file or synchronized file.
+        - index_file (str): Path of the ".npz" file to write.
+
+    Returns:
+        - None
+
+    Raises:
+        - ValueError: If the recording has no samples.
+    """
+    t, values = _load_source(source_file)
+    if not len(t):
+        raise ValueError(f"{source_file} has no samples")
+    data = pd.DataFrame(values[:, 3:6], columns=data_analysis.EJES)
+    thresholds = data_analysis.calcular_umbrales(data)
+
+    arrays = {}
+    for resolution, level in build_pyramid(t, values).items():
+        for key, array in level.items():
+            arrays[f"{resolution}s_{key}"] = array
+    for key, array in find_events(t, values, thresholds).items():
+        arrays[f"event_{key}"] = array
+
+    info = {
+        "source": os.path.abspath(source_file),
+        "mtime": os.path.getmtime(source_file),
+        "size": os.path.getsize(source_file),
+        "samples": len(t),
+        "duration": float(t[-1] - t[0]) if len(t) else 0.0,
+        "thresholds": thresholds,
+    }
+
+    # Write to a temporary file first so a crash never leaves a broken index
+    tmp_path = index_file + ".tmp.npz"
+    np.savez(tmp_path, info=np.array(json.dumps(info)), **arrays)
+    os.replace(tmp_path, index_file)
+
+
+def _index_or_skip(source_file: str, index_file: str) -> None:
+    """
+    Index a recording, printing a warning instead of failing when it is
+    empty or cannot be read, so the rest of the folder is still indexed.
+    """
+    try:
+        index_recording(source_file, index_file)
+    except (OSError, ValueError) as error:
+        print(f"Recording not indexed: {error}")
+
+
+class ImuIndex:
+    """
+    On-disk index of the IMU data of every recording.
+
+    Every recording has a ".npz" file with its min/max/mean pyramid at the
+    resolutions in LEVELS and its brake events. The manifest (index.json)
+    keeps the source of every recording and the fleet event table
+    (events.csv) all the events, so queries never read the raw data.
+    """
+
+    def __init__(self, index_dir: str = None):
+        """
+        Args:
+            index_dir (str): Folder of the index. Defaults to the configured one.
+        """
+        self.index_dir = index_dir or config.getIndexFolder()
+        self.manifest_path = os.path.join(self.index_dir, MANIFEST_FILE)
+        self.events_path = os.path.join(self.index_dir, EVENTS_FILE)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        self._levels = {}
+
+    def update(self, source_dir: str = None, force: bool = False) -> list:
+        """
+        Index the new or changed recordings of a folder.
+
+        A recording is indexed again only when the size or modification time
+        of its source changed. Recordings whose source disappeared are
+        removed. The recordings are indexed in parallel. Empty or unreadable
+        recordings are skipped with a warning.
+
+        Args:
+            - source_dir (str): Folder with ".gcsv" files or synchronized
+                files. Defaults to the configured GCSV folder.
+            - force (bool): Index every recording again.
+
+        Returns:
+            - updated (list): Names of the recordings that were indexed.
+        """
+        source_dir = source_dir or config.getGCSVFolder()
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        sources = {}
+        if os.path.isdir(source_dir):
+            for filename in sorted(os.listdir(source_dir)):
+                if _is_source(filename):
+                    name = os.path.splitext(filename)[0]
+                    sources.setdefault(name, os.path.join(source_dir, filename))
+
+        args = []
+        for name, source_file in sources.items():
+            entry = self.manifest.get(name)
+            index_file = _index_path(self.index_dir, name)
+            if (
+                not force
+                and entry is not None
+                and os.path.exists(index_file)
+                and entry["size"] == os.path.getsize(source_file)
+                and entry["mtime"] == os.path.getmtime(source_file)
+            ):
+                continue
+            if os.path.exists(index_file):
+                # A failed update must not leave the index of the old version
+                os.remove(index_file)
+            args.append([source_file, index_file])
+        parallelism.executeFunction(_index_or_skip, args)
+
+        # The skipped recordings have no index and are forgotten below
+        updated = []
+        for source_file, index_file in args:
+            name = os.path.splitext(os.path.basename(index_file))[0]
+            if os.path.exists(index_file):
+                updated.append(name)
+            else:
+                del sources[name]
+
+        # Forget the recordings of this folder that are gone
+        folder = os.path.abspath(source_dir)
+        for name, entry in list(self.manifest.items()):
+            if os.path.dirname(entry["source"]) == folder and name not in sources:
+                del self.manifest[name]
+                if os.path.exists(_index_path(self.index_dir, name)):
+                    os.remove(_index_path(self.index_dir, name))
+
+        for name in updated:
+            with np.load(_index_path(self.index_dir, name)) as index:
+                self.manifest[name] = json.loads(str(index["info"]))
+            self._levels.pop(name, None)
+
+        if updated or not os.path.exists(self.events_path):
+            self._write_events()
+        self._write_manifest()
+        return updated
+
+    def _write_manifest(self) -> None:
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _write_events(self) -> None:
+        """
+        Rebuild the fleet event table from the index of every recording.
+        """
+        tables = []
+        for name, entry in self.manifest.items():
+            with np.load(_index_path(self.index_dir, name)) as index:
+                table = pd.DataFrame(
+                    {
+                        key[len("event_") :]: index[key]
+                        for key in index.files
+                        if key.startswith("event_")
+                    }
+                )
+            table.insert(0, "recorded", entry["mtime"])
+            table.insert(0, "video", name)
+            tables.append(table)
+
+        columns = ["video", "recorded", "start", "end"] + data_analysis.EJES
+        events = pd.concat(tables) if tables else pd.DataFrame(columns=columns)
+        events.to_csv(self.events_path, index=False)
+
+    def _level(self, name: str, resolution: int) -> dict:
+        """
+        Return one pyramid level of a recording, loading it on first use.
+        """
+        if name not in self._levels:
+            with np.load(_index_path(self.index_dir, name)) as index:
+                self._levels[name] = {
+                    key: index[key] for key in index.files if key[0].isdigit()
+                }
+        arrays = self._levels[name]
+        prefix = f"{resolution}s_"
+        return {
+            key[len(prefix) :]: array
+            for key, array in arrays.items()
+            if key.startswith(prefix)
+        }
+
+    def videos(self, since: float = None, until: float = None) -> list:
+        """
+        Names of the indexed recordings, optionally only the ones recorded
+        (source modification time, epoch seconds) between since and until.
+        """
+        return [
+            name
+            for name, entry in sorted(self.manifest.items())
+            if (since is None or entry["mtime"] >= since)
+            and (until is None or entry["mtime"] < until)
+        ]
+
+    def query_range(
+        self, name: str, start: float = 0.0, end: float = None, resolution: int = 1
+    ) -> pd.DataFrame:
+        """
+        Buckets of one recording that overlap a time range.
+
+        Args:
+            - name (str): Name of the recording.
+            - start, end (float): Range in seconds from the first sample.
+            - resolution (int): Level of the pyramid, one of LEVELS.
+
+        Returns:
+            - buckets (pd.DataFrame): "start", "count" and the min_, max_
+                and mean_ columns of every channel.
+        """
+        level = self._level(name, resolution)
+        mask = level["start"] + resolution > start
+        if end is not None:
+            mask &= level["start"] < end
+
+        buckets = {"start": level["start"][mask], "count": level["count"][mask]}
+        for stat in ("min", "max", "mean"):
+            for i, channel in enumerate(CHANNELS):
+                buckets[f"{stat}_{channel}"] = level[stat][mask, i]
+        return pd.DataFrame(buckets)
+
+    def summary(self, name: str, start: float = 0.0, end: float = None) -> dict:
+        """
+        Minimum, maximum and mean of every channel in a time range, computed
+        from the finest level of the pyramid.
+
+        Raises:
+            - ValueError: If the range has no samples.
+        """
+        buckets = self.query_range(name, start, end, LEVELS[0])
+        count = buckets["count"].to_numpy()
+        if not count.sum():
+            raise ValueError(f"{name} has no samples between {start} and {end} s")
+        result = {}
+        for channel in CHANNELS:
+            result[channel] = {
+                "min": buckets[f"min_{channel}"].min(),
+                "max": buckets[f"max_{channel}"].max(),
+                "mean": (buckets[f"mean_{channel}"] * count).sum() / count.sum(),
+            }
+        return result
+
+    def query_threshold(
+        self,
+        channel: str,
+        below: float = None,
+        above: float = None,
+        videos: list = None,
+        resolution: int = 1,
+    ) -> pd.DataFrame:
+        """
+        Find the moments where a channel goes below or above a value.
+
+        The coarsest level is checked first and only the buckets inside its
+        matches are checked at the finer levels.
+
+        Args:
+            - channel (str): One of CHANNELS.
+            - below (float): Match buckets whose minimum is lower.
+            - above (float): Match buckets whose maximum is higher.
+            - videos (list): Recordings to search, every one by default.
+            - resolution (int): Level of the returned buckets, one of LEVELS.
+
+        Returns:
+            - matches (pd.DataFrame): "video", "start", "end", "min" and
+                "max" of every matching bucket.
+        """
+        if below is None and above is None:
+            raise ValueError("Either below or above must be given")
+        column = CHANNELS.index(channel)
+        levels = [level for level in LEVELS if level >= resolution][::-1]
+
+        tables = []
+        for name in videos if videos is not None else self.videos():
+            windows = None  # Start of the matching buckets of the coarser level
+            for level_resolution in levels:
+                level = self._level(name, level_resolution)
+                mask = np.zeros(len(level["start"]), dtype=bool)
+                if below is not None:
+                    mask |= level["min"][:, column] < below
+                if above is not None:
+                    mask |= level["max"][:, column] > above
+                if windows is not None:
+                    parent = level["start"] // previous * previous
+                    mask &= np.isin(parent, windows)
+                windows = level["start"][mask]
+                previous = level_resolution
+                if not len(windows):
+                    break
+
+            if len(windows):
+                tables.append(
+                    pd.DataFrame(
+                        {
+                            "video": name,
+                            "start": windows,
+                            "end": windows + resolution,
+                            "min": level["min"][mask, column],
+                            "max": level["max"][mask, column],
+                        }
+                    )
+                )
+
+        if not tables:
+            return pd.DataFrame(columns=["video", "start", "end", "min", "max"])
+        return pd.concat(tables, ignore_index=True)
+
+    def query_events(
+        self, since: float = None, until: float = None, videos: list = None
+    ) -> pd.DataFrame:
+        """
+        Brake events of the fleet, optionally only the ones of recordings
+        made between since and until (epoch seconds) or of some videos.
+        """
+        events = pd.read_csv(self.events_path)
+        mask = np.ones(len(events), dtype=bool)
+        if since is not None:
+            mask &= events["recorded"] >= since
+        if until is not None:
+            mask &= events["recorded"] < until
+        if videos is not None:
+            mask &= events["video"].isin(videos)
+        return events[mask]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Index the IMU data of the recordings and query it."
+    )
+    parser.add_argument("-s", "--source", help="Folder with the recordings")
+    parser.add_argument("-i", "--index", help="Folder of the index")
+    parser.add_argument(
+        "-f", "--force", action="store_true", help="Index every recording again"
+    )
+    parser.add_argument("--days", type=float, help="Print the events of the last days")
+    args = parser.parse_args()
+
+    index = ImuIndex(args.index)
+    updated = index.update(args.source, force=args.force)
+    print(f"{len(updated)} grabaciones indexadas, {len(index.manifest)} en total.")
+
+    if args.days is not None:
+        events = index.query_events(since=time.time() - args.days * 86400)
+        print(events.to_string(index=False))
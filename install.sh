@@ -4,16 +4,19 @@
 SERVICE_FILE="/etc/systemd/system/my_daemon.service"
 
 # Define the script path and username (you can change these variables if needed)
-SCRIPT_PATH="main.py"
+# The device daemon keeps running and watches the mounts itself
+SCRIPT_DIR=$(dirname "$(realpath "${BASH_SOURCE[0]}")")
+SCRIPT_PATH="$SCRIPT_DIR/daemon.py"
 USERNAME="your_username"
 
 # Create or overwrite the service file with the desired configuration
 echo "[Unit]
-Description=My Python Daemon
+Description=Camera offload daemon
 
 [Service]
+WorkingDirectory=$SCRIPT_DIR
 ExecStart=/usr/bin/python3 $SCRIPT_PATH
-Restart=always
+Restart=on-failure
 User=$USERNAME
 
 [Install]
@@ -0,0 +1,424 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+import config
+import sync
+import stabilizer
+from presetRegistry import PresetRegistry
+
+STATE_FILE = "pipeline_state.json"
+MAX_ATTEMPTS = 2  # Runs of a task before it is left as failed
+
+
+def _stem(video_path: str) -> str:
+    return os.path.splitext(os.path.basename(video_path))[0]
+
+
+def _signature(video_path: str, gcsv_path: str) -> list:
+    """
+    Size and modification time of the inputs of a recording, to notice when
+    they are replaced. None if one of them is missing.
+    """
+    try:
+        stats = [os.stat(path) for path in (video_path, gcsv_path)]
+    except OSError:
+        return None
+    return [[stat.st_size, stat.st_mtime] for stat in stats]
+
+
+def run_stabilize(video_path: str, gcsv_path: str, paths: dict) -> list:
+    """
+    Stabilize a video with the preset of the device it came from.
+    """
+    output_path = stabilizer.stabilized_path(video_path)
+    if stabilizer.is_complete(video_path, output_path):
+        return [output_path]
+
+    registry = PresetRegistry()
+    preset_path = registry.preset_for(video_path)
+    if preset_path is None:
+        raise RuntimeError(
+            f"No preset for {video_path}: {registry.missing(video_path)}"
+        )
+    settings = config.getStabilizationSettings()
+    if not stabilizer.stabilize(
+        video_path, gcsv_path, preset_path, settings["binary"], settings["retries"]
+    ):
+        raise RuntimeError(f"Gyroflow failed on {video_path}")
+    return [output_path]
+
+
+def run_audio(video_path: str, gcsv_path: str, paths: dict) -> list:
+    """
+    Extract the audio of a video to a WAV file.
+    """
+    # Only this stage needs ffmpeg-python
+    import extractAudio
+
+    output_path = _outputs("audio", video_path, paths)[0]
+    os.makedirs(paths["audio_dir"], exist_ok=True)
+
+    # A crash must not leave a truncated WAV under the final name
+    with tempfile.TemporaryDirectory(dir=paths["audio_dir"]) as tmp_dir:
+        extractAudio.extractAudio(video_path, tmp_dir)
+        os.replace(os.path.join(tmp_dir, os.path.basename(output_path)), output_path)
+    return [output_path]
+
+
+def run_sync(video_path: str, gcsv_path: str, paths: dict) -> list:
+    """
+    Synchronize the sensor data of a recording with its frames.
+    """
+    output_path = _outputs("sync", video_path, paths)[0]
+    os.makedirs(paths["sync_dir"], exist_ok=True)
+    sync.sync_pair(video_path, gcsv_path, output_path)
+    return [output_path]
+
+
+def run_analysis(video_path: str, gcsv_path: str, paths: dict) -> list:
+    """
+    Overlay, detect and summarize the stabilized video with the synchronized
+    data, see pipeline.process_clip.
+    """
+    # Loads YOLO, keep it out of the processes of the other stages
+    import pipeline
+
+    outputs = pipeline.process_clip(
+        stabilizer.stabilized_path(video_path),
+        gcsv_path,
+        paths["output_dir"],
+        synced_file=_outputs("sync", video_path, paths)[0],
+    )
+    return list(outputs.values())
+
+
+# Every stage of a recording: the stages it needs, the function that runs it,
+# the executor it runs in and how many of its tasks can run at once
+STAGES = {
+    "stabilize": {"needs": [], "run": run_stabilize, "executor": "thread"},
+    "audio": {"needs": [], "run": run_audio, "executor": "thread"},
+    "sync": {"needs": [], "run": run_sync, "executor": "process"},
+    "analysis": {
+        "needs": ["stabilize", "sync"],
+        "run": run_analysis,
+        "executor": "process",
+    },
+}
+
+
+def _outputs(stage: str, video_path: str, paths: dict) -> list:
+    """
+    Files a stage writes for a recording, which must exist for it to be done.
+    """
+    stem = _stem(video_path)
+    if stage == "stabilize":
+        return [stabilizer.stabilized_path(video_path)]
+    if stage == "audio":
+        return [os.path.join(paths["audio_dir"], f"{stem}.wav")]
+    if stage == "sync":
+        return [os.path.join(paths["sync_dir"], f"{stem}.npz")]
+    if stage == "analysis":
+        stabilized = _stem(stabilizer.stabilized_path(video_path))
+        return [os.path.join(paths["output_dir"], f"{stabilized}_segments.csv")]
+    raise ValueError(f"Unknown stage '{stage}'")
+
+
+class Orchestrator:
+    """
+    Runs every recording through the stages in STAGES as a DAG.
+
+    A recording enters when its video and GCSV files are both in the
+    configured folders, which is when the offload of the pair finishes. Each
+    task starts as soon as the tasks it needs are done, so independent
+    stages, like the audio and the stabilization, run at the same time.
+
+    The state of every task is written to pipeline_state.json after each
+    change. A new run reads it back: done tasks whose outputs exist are not
+    run again, and tasks that were running when the process died or that
+    failed start over. When the video or the GCSV of a recording is replaced
+    every task of it starts over.
+    """
+
+    def __init__(
+        self,
+        paths: dict = None,
+        limits: dict = None,
+        processes: int = None,
+        interval: float = 5.0,
+    ):
+        """
+        Args:
+            paths (dict): "video_dir", "gcsv_dir", "sync_dir", "audio_dir"
+                and "output_dir". Defaults to the configured folders.
+            limits (dict): Tasks of every stage that can run at once. The
+                stabilization defaults to stabilizer.job_budget and the rest
+                to 1.
+            processes (int): Workers of the process pool.
+            interval (float): Seconds between checks for new recordings.
+        """
+        self.paths = {
+            "video_dir": config.getVideoFolder(),
+            "gcsv_dir": config.getGCSVFolder(),
+            "sync_dir": config.getSyncFolder(),
+            "audio_dir": config.getAudioFolder(),
+            "output_dir": config.getOutputFolder(),
+        }
+        self.paths.update(paths or {})
+
+        settings = config.getStabilizationSettings()
+        self.limits = {stage: 1 for stage in STAGES}
+        self.limits["stabilize"] = stabilizer.job_budget(
+            settings["cores_per_job"],
+            settings["memory_per_job_gb"],
+            settings["max_jobs"],
+        )
+        self.limits.update(limits or {})
+
+        self.interval = interval
+        self.executors = {
+            "thread": ThreadPoolExecutor(
+                max_workers=sum(
+                    self.limits[stage]
+                    for stage, spec in STAGES.items()
+                    if spec["executor"] == "thread"
+                )
+            ),
+            "process": ProcessPoolExecutor(max_workers=processes),
+        }
+        self.state_path = os.path.join(self.paths["output_dir"], STATE_FILE)
+        self.state = self._load_state()
+        self.running = {}  # Future -> (stem, stage)
+        self.woken = threading.Event()
+
+    def _load_state(self) -> dict:
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        for stem, recording in state.items():
+            if self._replaced(stem, recording):
+                continue
+            for stage, task in recording["tasks"].items():
+                outputs = _outputs(stage, recording["video"], self.paths)
+                if task["status"] == "running":
+                    # The process died while it was running
+                    task["status"] = "pending"
+                elif task["status"] == "failed":
+                    # Failed in an earlier run, the cause may have been fixed
+                    task["status"] = "pending"
+                    task["attempts"] = 0
+                elif task["status"] == "done" and not all(
+                    os.path.exists(path) for path in outputs
+                ):
+                    task["status"] = "pending"
+        return state
+
+    def _replaced(self, stem: str, recording: dict) -> bool:
+        """
+        Start every task of a recording over if its inputs changed since the
+        tasks ran, removing the outputs made from the old ones.
+
+        Returns:
+            - replaced (bool): Whether the inputs changed.
+        """
+        signature = _signature(recording["video"], recording["gcsv"])
+        if "inputs" not in recording:
+            # State written before the inputs were recorded
+            recording["inputs"] = signature
+        if signature is None or signature == recording["inputs"]:
+            return False
+        for stage in recording["tasks"]:
+            for path in _outputs(stage, recording["video"], self.paths):
+                if os.path.exists(path):
+                    os.remove(path)
+            recording["tasks"][stage] = {"status": "pending", "attempts": 0}
+        recording["inputs"] = signature
+        print(f"{stem}: inputs changed, starting over")
+        return True
+
+    def _save_state(self) -> None:
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def discover(self) -> list:
+        """
+        Add the recordings whose video and GCSV files are both present, and
+        start over the ones whose files were replaced.
+
+        Returns:
+            - new (list): Names of the recordings that were added or started
+                over.
+        """
+        new = []
+        # A recording is started over once its running tasks are collected
+        running = {stem for stem, _ in self.running.values()}
+        for video_path, gcsv_path in sync.find_pairs(
+            self.paths["video_dir"], self.paths["gcsv_dir"]
+        ):
+            stem = _stem(video_path)
+            if stem in self.state:
+                if stem not in running and self._replaced(stem, self.state[stem]):
+                    new.append(stem)
+                continue
+            self.state[stem] = {
+                "video": video_path,
+                "gcsv": gcsv_path,
+                "inputs": _signature(video_path, gcsv_path),
+                "tasks": {
+                    stage: {"status": "pending", "attempts": 0} for stage in STAGES
+                },
+            }
+            new.append(stem)
+        if new:
+            self._save_state()
+        return new
+
+    def _ready(self) -> list:
+        """
+        Pending tasks whose dependencies are done, in order of arrival.
+        """
+        ready = []
+        for stem, recording in self.state.items():
+            tasks = recording["tasks"]
+            for stage, spec in STAGES.items():
+                task = tasks[stage]
+                if task["status"] != "pending":
+                    continue
+                if all(tasks[need]["status"] == "done" for need in spec["needs"]):
+                    ready.append((stem, stage))
+        return ready
+
+    def _submit_ready(self) -> None:
+        busy = {stage: 0 for stage in STAGES}
+        for stem, stage in self.running.values():
+            busy[stage] += 1
+
+        for stem, stage in self._ready():
+            if busy[stage] >= self.limits[stage]:
+                continue
+            recording = self.state[stem]
+            spec = STAGES[stage]
+            future = self.executors[spec["executor"]].submit(
+                spec["run"], recording["video"], recording["gcsv"], self.paths
+            )
+            self.running[future] = (stem, stage)
+            task = recording["tasks"][stage]
+            task["status"] = "running"
+            task["attempts"] += 1
+            task["started"] = time.time()
+            busy[stage] += 1
+            print(f"{stem}: {stage} started")
+        self._save_state()
+
+    def _collect(self, futures) -> None:
+        for future in futures:
+            stem, stage = self.running.pop(future)
+            task = self.state[stem]["tasks"][stage]
+            task["seconds"] = time.time() - task.pop("started", time.time())
+            try:
+                task["outputs"] = future.result()
+                task["status"] = "done"
+                task.pop("error", None)
+                print(f"{stem}: {stage} done in {task['seconds']:.1f} s")
+            except Exception as error:
+                task["error"] = str(error)
+                task["status"] = (
+                    "pending" if task["attempts"] < MAX_ATTEMPTS else "failed"
+                )
+                print(f"{stem}: {stage} failed: {error}")
+        self._save_state()
+
+    def wake(self, *args) -> None:
+        """
+        Look for new recordings now, e.g. from daemon.DeviceDaemon's
+        on_offloaded.
+        """
+        self.woken.set()
+
+    def run(self, watch: bool = False) -> dict:
+        """
+        Run the tasks until every known recording is finished or failed.
+
+        Args:
+            - watch (bool): Keep running and take the new recordings as
+                they appear, until interrupted.
+
+        Returns:
+            - state (dict): The state of every recording and task.
+        """
+        try:
+            while True:
+                self.discover()
+                self._submit_ready()
+                if not self.running:
+                    if not watch:
+                        break
+                    self.woken.wait(self.interval)
+                    self.woken.clear()
+                    continue
+                done, _ = wait(
+                    list(self.running),
+                    timeout=self.interval if watch else None,
+                    return_when=FIRST_COMPLETED,
+                )
+                self._collect(done)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for executor in self.executors.values():
+                executor.shutdown(wait=True)
+            # Tasks collected while shutting down are kept, the rest resume
+            self._collect([future for future in list(self.running) if future.done()])
+        return self.state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run every recording through stabilization, audio, sync and analysis."
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="Keep running and process new recordings as they arrive",
+    )
+    parser.add_argument(
+        "-d",
+        "--daemon",
+        action="store_true",
+        help="Also offload the cameras as they are plugged in (implies --watch)",
+    )
+    parser.add_argument(
+        "-p", "--processes", type=int, help="Workers for the sync and analysis"
+    )
+    args = parser.parse_args()
+
+    orchestrator = Orchestrator(processes=args.processes)
+    if args.daemon:
+        import daemon
+
+        device_daemon = daemon.DeviceDaemon(on_offloaded=orchestrator.wake)
+        threading.Thread(target=device_daemon.run, daemon=True).start()
+
+    state = orchestrator.run(watch=args.watch or args.daemon)
+    failed = [
+        f"{stem}/{stage}"
+        for stem, recording in state.items()
+        for stage, task in recording["tasks"].items()
+        if task["status"] == "failed"
+    ]
+    print(f"{len(state)} recordings, {len(failed)} failed tasks {failed}")
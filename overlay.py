@@ -1,104 +1,691 @@
-import csv
 import cv2
 import numpy as np
+import os
 import sys
+import time
+import shutil
+import tempfile
+import ffmpegUtils
+import parallelism
+from sync import SYNC_COLUMNS, load_synced
 
 
 def read_csv_data(csv_file):
-    synced_data = []
-    with open(csv_file, newline="") as f:
-        reader = csv.reader(f)
-        header = next(reader)  # Leer encabezado
-        for row in reader:
-            frame_num = int(row[0])
-            timestamp = float(row[1])
-            rx = float(row[2])
-            ry = float(row[3])
-            rz = float(row[4])
-            ax = float(row[5])
-            ay = float(row[6])
-            az = float(row[7])
-            synced_data.append([frame_num, timestamp, rx, ry, rz, ax, ay, az])
-    return synced_data
+    """
+    Read a synchronized file as a dictionary of NumPy columns, the same layout
+    returned by sync.synchronize_data. Every format of sync.SAVERS is read.
+    """
+    return load_synced(csv_file)
 
 
-def overlay_video_with_data(
-    video_file, csv_file, output_file="output_with_overlay.mp4", fps=60
+class SensorData:
+    """
+    Base of the frame-indexed readers returned by open_sensor_data. They are
+    context managers that close what they opened on exit.
+    """
+
+    def close(self):
+        """
+        Release the resources of the reader.
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SensorArray(SensorData):
+    """
+    Frame-indexed access to synchronized values held in an array, which can
+    be a memory-mapped file written by sync.save_to_npy.
+    """
+
+    def __init__(self, table):
+        """
+        Args:
+            table (np.ndarray): Array of shape (n, 8) in SYNC_COLUMNS order.
+        """
+        self.values = table[:, 1:]
+
+    def get(self, frame_idx):
+        """
+        Return the 7 values of a frame, or None if there is no such frame.
+        """
+        if frame_idx >= len(self.values):
+            return None
+        return self.values[frame_idx]
+
+
+class SensorCsvReader(SensorData):
+    """
+    Frame-indexed access to a synchronized CSV without loading it.
+
+    Rows are parsed only when they are requested. Reading forward is
+    sequential; going back seeks to the nearest of the byte offsets saved
+    every checkpoint_every rows, so memory stays small for any clip length.
+    With follow=True a file that is still being written is waited for, up to
+    timeout seconds without new rows.
+    """
+
+    def __init__(self, csv_file, follow=False, timeout=10.0, checkpoint_every=4096):
+        """
+        Args:
+            csv_file (str): Path to the synchronized CSV.
+            follow (bool): Wait for rows that are not written yet.
+            timeout (float): Seconds to wait for new rows when following.
+            checkpoint_every (int): Rows between saved byte offsets.
+        """
+        self.file = open(csv_file, "rb")
+        self.follow = follow
+        self.timeout = timeout
+        self.checkpoint_every = checkpoint_every
+
+        if self._readline() is None:  # Encabezado
+            self.file.close()
+            raise ValueError(f"{csv_file} has no header")
+        self.next_row = 0
+        self.checkpoints = {0: self.file.tell()}
+        self.last = (None, None)
+
+    def _readline(self):
+        """
+        Return the next complete line, or None at the end of the data.
+        """
+        waited = 0.0
+        while True:
+            position = self.file.tell()
+            line = self.file.readline()
+            if line.endswith(b"\n"):
+                return line
+            if not self.follow:
+                return line or None
+            if waited >= self.timeout:
+                return None
+            # Incomplete line: go back and wait for the writer
+            self.file.seek(position)
+            time.sleep(0.05)
+            waited += 0.05
+
+    def get(self, frame_idx):
+        """
+        Return the 7 values of a frame, or None if there is no such frame.
+        """
+        if self.last[0] == frame_idx:
+            return self.last[1]
+
+        if frame_idx < self.next_row:
+            checkpoint = frame_idx - frame_idx % self.checkpoint_every
+            self.file.seek(self.checkpoints[checkpoint])
+            self.next_row = checkpoint
+
+        row = None
+        while self.next_row <= frame_idx:
+            if self.next_row % self.checkpoint_every == 0:
+                self.checkpoints[self.next_row] = self.file.tell()
+            line = self._readline()
+            if line is None:
+                return None
+            self.next_row += 1
+            row = line
+
+        values = [float(value) for value in row.split(b",")[1:8]]
+        self.last = (frame_idx, values)
+        return values
+
+    def close(self):
+        """
+        Close the CSV file.
+        """
+        self.file.close()
+
+
+def open_sensor_data(source, follow=False, timeout=10.0):
+    """
+    Open synchronized sensor data for frame-indexed reading.
+
+    Args:
+        - source (str, dict or np.ndarray): A ".npy" file written by
+            sync.save_to_npy (memory-mapped), a ".npz" or ".parquet" file
+            with one column per value, a synchronized CSV (read lazily), the
+            columns returned by sync.synchronize_data or an array of shape
+            (n, 8).
+        - follow (bool): For CSV files, wait for rows still being written.
+        - timeout (float): Seconds to wait for new rows when following.
+
+    Returns:
+        - data (SensorData): A reader whose get(frame_idx) returns the 7
+            values of a frame, or None when there are no more frames. Close
+            it, or use it in a with statement, when done.
+    """
+    if isinstance(source, dict):
+        return SensorArray(np.column_stack([source[name] for name in SYNC_COLUMNS]))
+    if isinstance(source, np.ndarray):
+        return SensorArray(source)
+    if source.lower().endswith(".npy"):
+        return SensorArray(np.load(source, mmap_mode="r"))
+    if source.lower().endswith((".npz", ".parquet")):
+        return open_sensor_data(load_synced(source))
+    return SensorCsvReader(source, follow=follow, timeout=timeout)
+
+
+TEXT_FONT = cv2.FONT_HERSHEY_SIMPLEX
+TEXT_SCALE = 0.6
+TEXT_COLOR = (0, 0, 255)
+TEXT_THICKNESS = 2
+TEXT_ORIGIN = (10, 30)  # Posición de la primera línea (x, y de la línea base)
+TEXT_LINE_HEIGHT = 30
+# Renderer of the overlay text, see get_text_renderer. With the pinned OpenCV
+# 4.11 the atlas draws the 7 lines about twice as fast as cv2.putText, run
+# benchmark_renderers again after upgrading OpenCV
+TEXT_RENDERER = "atlas"
+
+
+def format_overlay_lines(timestamp, rx, ry, rz, ax, ay, az):
+    """
+    Text lines drawn on each frame.
+    """
+    return [
+        f"Timestamp: {timestamp:.3f} s",
+        f"Rx: {rx:.3f}",
+        f"Ry: {ry:.3f}",
+        f"Rz: {rz:.3f}",
+        f"Ax: {ax:.3f}",
+        f"Ay: {ay:.3f}",
+        f"Az: {az:.3f}",
+    ]
+
+
+def draw_text_puttext(frame, text_lines):
+    """
+    Draw the lines with one cv2.putText call each over the full frame.
+    """
+    text_x, text_y = TEXT_ORIGIN
+    for line in text_lines:
+        cv2.putText(
+            frame,
+            line,
+            (text_x, text_y),
+            TEXT_FONT,
+            TEXT_SCALE,
+            TEXT_COLOR,
+            TEXT_THICKNESS,
+            cv2.LINE_AA,
+        )
+        text_y += TEXT_LINE_HEIGHT
+
+
+class TextOverlay:
+    """
+    Draws text lines from glyphs rendered once with cv2.putText.
+
+    Every glyph is kept as a small anti-aliased alpha mask. For each frame the
+    masks are composed into a reusable buffer the size of the text block and
+    only that region of the frame is alpha-blended.
+    """
+
+    def __init__(
+        self,
+        origin=TEXT_ORIGIN,
+        line_height=TEXT_LINE_HEIGHT,
+        font=TEXT_FONT,
+        scale=TEXT_SCALE,
+        color=TEXT_COLOR,
+        thickness=TEXT_THICKNESS,
+        max_cached_lines=4096,
+    ):
+        """
+        Args:
+            origin (tuple): Baseline position (x, y) of the first line.
+            line_height (int): Distance in pixels between baselines.
+            font (int): OpenCV font face.
+            scale (float): Font scale.
+            color (tuple): BGR text color.
+            thickness (int): Stroke thickness.
+            max_cached_lines (int): Composed lines kept for reuse.
+        """
+        self.origin = origin
+        self.line_height = line_height
+        self.font = font
+        self.scale = scale
+        self.thickness = thickness
+        self.color = color
+        self.max_cached_lines = max_cached_lines
+
+        (_, self.ascent), self.descent = cv2.getTextSize("Tg", font, scale, thickness)
+        self.pad = thickness + 1
+        self.glyph_height = self.ascent + self.descent + 2 * self.pad
+        self.glyphs = {}
+        self.lines = {}
+        self.buffer = np.zeros((0, 0, 3), dtype=np.uint8)
+        self.color_buffer = np.zeros((0, 0, 3), dtype=np.uint8)
+
+    def _glyph(self, char):
+        """
+        Return the alpha mask of a character and its advance, rendering it the
+        first time. The mask keeps a margin of self.pad on both sides for the
+        stroke that goes past the advance.
+        """
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            # getTextSize adds the thickness once per call, measure a long run
+            # of the character to get its advance with the fraction putText uses
+            (width, _), _ = cv2.getTextSize(
+                char * 64, self.font, self.scale, self.thickness
+            )
+            advance = (width - self.thickness) / 64
+            canvas = np.zeros(
+                (self.glyph_height, int(np.ceil(advance)) + 2 * self.pad), np.uint8
+            )
+            cv2.putText(
+                canvas,
+                char,
+                (self.pad, self.pad + self.ascent),
+                self.font,
+                self.scale,
+                255,
+                self.thickness,
+                cv2.LINE_AA,
+            )
+            glyph = (np.repeat(canvas[:, :, None], 3, 2), advance)
+            self.glyphs[char] = glyph
+        return glyph
+
+    def _line(self, text):
+        """
+        Return the glyphs of a line with the x offset of each one, the same
+        positions putText draws them at, and the width of the line.
+        """
+        line = self.lines.get(text)
+        if line is None:
+            if len(self.lines) >= self.max_cached_lines:
+                self.lines.clear()
+            placed = []
+            position = 0.0
+            for char in text:
+                glyph, advance = self._glyph(char)
+                placed.append((glyph, round(position)))
+                position += advance
+            line = (placed, round(position) + 2 * self.pad + 1)
+            self.lines[text] = line
+        return line
+
+    def _compose(self, text_lines):
+        """
+        Compose the glyphs of all lines into the buffer and return the used
+        (height, width).
+        """
+        lines = [self._line(line) for line in text_lines]
+        height = self.line_height * (len(lines) - 1) + self.glyph_height
+        width = max(line_width for _, line_width in lines)
+
+        if self.buffer.shape[0] < height or self.buffer.shape[1] < width:
+            shape = (
+                max(height, self.buffer.shape[0]),
+                max(width, self.buffer.shape[1]),
+                3,
+            )
+            self.buffer = np.zeros(shape, np.uint8)
+            self.color_buffer = np.empty(shape, np.uint8)
+            self.color_buffer[:] = self.color
+
+        buffer = self.buffer[:height, :width]
+        buffer.fill(0)
+        for i, (glyphs, _) in enumerate(lines):
+            top = i * self.line_height
+            for glyph, x in glyphs:
+                region = buffer[top : top + glyph.shape[0], x : x + glyph.shape[1]]
+                np.maximum(region, glyph, out=region)
+        return height, width
+
+    def draw(self, frame, text_lines):
+        """
+        Blend the text lines into the frame in place.
+        """
+        if not text_lines:
+            return
+        height, width = self._compose(text_lines)
+
+        # Top-left corner of the text block in the frame
+        left = self.origin[0] - self.pad
+        top = self.origin[1] - self.ascent - self.pad
+
+        # Clip the block to the frame
+        y0, x0 = max(top, 0), max(left, 0)
+        y1 = min(top + height, frame.shape[0])
+        x1 = min(left + width, frame.shape[1])
+        if y0 >= y1 or x0 >= x1:
+            return
+
+        alpha = self.buffer[y0 - top : y1 - top, x0 - left : x1 - left]
+        color = self.color_buffer[: y1 - y0, : x1 - x0]
+        roi = frame[y0:y1, x0:x1]
+        background = cv2.multiply(roi, cv2.bitwise_not(alpha), scale=1 / 255)
+        text = cv2.multiply(color, alpha, scale=1 / 255)
+        roi[:] = cv2.add(background, text)
+
+
+def open_video_writer(
+    output_file,
+    width,
+    height,
+    fps,
+    encoder="ffmpeg",
+    audio_source=None,
+    preset="veryfast",
+    crf=23,
+    threads=0,
 ):
-    synced_data = read_csv_data(csv_file)
+    """
+    Open a writer for the output video.
 
-    cap = cv2.VideoCapture(video_file)
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    With encoder="ffmpeg" the frames are piped to an ffmpeg process. If ffmpeg
+    is not installed, or with encoder="opencv", the OpenCV codecs are tried in
+    order instead.
+
+    Returns:
+        - out: An object with write/isOpened/release, or None if no writer
+            could be opened.
+    """
+    if encoder == "ffmpeg" and shutil.which("ffmpeg"):
+        out = ffmpegUtils.FFmpegWriter(
+            output_file,
+            width,
+            height,
+            fps,
+            audioSource=audio_source,
+            preset=preset,
+            crf=crf,
+            threads=threads,
+        )
+        if out.isOpened():
+            return out
+        print("Error: No se pudo iniciar ffmpeg, se usará OpenCV")
 
     # Probar diferentes codecs hasta encontrar uno compatible
     codecs = ["H264", "avc1", "mp4v", "X264"]
-    out = None
 
     for codec in codecs:
         fourcc = cv2.VideoWriter_fourcc(*codec)
         out = cv2.VideoWriter(output_file, fourcc, fps, (width, height))
         if out.isOpened():
             print(f"VideoWriter inicializado correctamente con codec: {codec}")
-            break
+            return out
         else:
             print(f"Error: No se pudo inicializar VideoWriter con codec: {codec}")
 
-    if not out.isOpened():
-        print(
-            "No se pudo inicializar ningún codec válido. Revisa tu instalación de OpenCV y FFmpeg."
-        )
-        return
+    return None
+
+
+def get_text_renderer(renderer):
+    """
+    Return the function used to draw the text lines on a frame.
+    """
+    if renderer == "atlas":
+        return TextOverlay().draw
+    elif renderer == "puttext":
+        return draw_text_puttext
+    raise ValueError(f"Unknown renderer '{renderer}'")
+
+
+def _render_frames(cap, out, data, draw_text, start_frame, end_frame):
+    """
+    Read the frames from start_frame to end_frame from cap, draw their values
+    and write them to out. Stops early when data has no more rows.
+    """
+    for frame_idx in range(start_frame, end_frame):
+        # Obtener datos sincronizados para este frame
+        values = data.get(frame_idx)
+        if values is None:
+            break
 
-    frame_idx = 0
-    while cap.isOpened():
         ret, frame = cap.read()
-        if not ret or frame_idx >= len(synced_data):
+        if not ret:
             break
 
-        # Obtener datos sincronizados para este frame
-        data = synced_data[frame_idx]
-        _, timestamp, rx, ry, rz, ax, ay, az = data
-
-        # Preparar el texto del overlay
-        text_lines = [
-            f"Timestamp: {timestamp:.3f} s",
-            f"Rx: {rx:.3f}",
-            f"Ry: {ry:.3f}",
-            f"Rz: {rz:.3f}",
-            f"Ax: {ax:.3f}",
-            f"Ay: {ay:.3f}",
-            f"Az: {az:.3f}",
-        ]
-
-        text_y = 30  # Posición inicial Y
-        text_x = 10  # Posición X a la izquierda
-
-        for line in text_lines:
-            cv2.putText(
-                frame,
-                line,
-                (text_x, text_y),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.6,
-                (0, 0, 255),
-                2,
-                cv2.LINE_AA,
-            )
-            text_y += 30  # Incrementar para la siguiente línea
+        # Preparar y dibujar el texto del overlay
+        draw_text(frame, format_overlay_lines(*values))
 
         out.write(frame)
-        frame_idx += 1
 
-    cap.release()
-    out.release()
+
+def render_chunk(
+    video_file,
+    source,
+    output_file,
+    start_frame,
+    end_frame,
+    fps,
+    renderer=TEXT_RENDERER,
+    encoder="ffmpeg",
+    preset="veryfast",
+    crf=23,
+    threads=0,
+):
+    """
+    Render the overlay of the frames from start_frame to end_frame into a
+    video without audio. Used by each process of overlay_video_parallel,
+    source is opened with open_sensor_data.
+    """
+    cap = cv2.VideoCapture(video_file)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if start_frame:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+    out = open_video_writer(
+        output_file, width, height, fps, encoder, None, preset, crf, threads
+    )
+    if out is None:
+        cap.release()
+        raise RuntimeError(f"Could not open a video writer for {output_file}")
+
+    with open_sensor_data(source) as data:
+        try:
+            _render_frames(
+                cap, out, data, get_text_renderer(renderer), start_frame, end_frame
+            )
+        finally:
+            cap.release()
+            out.release()
+
+
+def split_at_keyframes(video_file, fps, n_frames, n_chunks):
+    """
+    Split the frames of a video into at most n_chunks ranges of similar
+    length that start at keyframes.
+
+    Returns:
+        - ranges (list): (start_frame, end_frame) tuples covering n_frames.
+    """
+    keyframes = np.round(
+        np.asarray(ffmpegUtils.getKeyframeTimes(video_file)) * fps
+    ).astype(np.int64)
+    keyframes = keyframes[(keyframes > 0) & (keyframes < n_frames)]
+
+    bounds = [0]
+    if len(keyframes):
+        targets = np.arange(1, n_chunks) * n_frames / n_chunks
+        nearest = np.abs(keyframes[None, :] - targets[:, None]).argmin(axis=1)
+        bounds += sorted(set(keyframes[nearest].tolist()))
+    bounds.append(n_frames)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def overlay_video_parallel(
+    video_file,
+    source,
+    output_file,
+    fps,
+    n_frames,
+    processes=None,
+    renderer=TEXT_RENDERER,
+    encoder="ffmpeg",
+    preset="veryfast",
+    crf=23,
+    threads=0,
+):
+    """
+    Render the overlay in keyframe-aligned chunks, one process per chunk, and
+    join them without re-encoding, copying the audio of the source.
+    Each process opens source itself, see open_sensor_data.
+    """
+    processes = processes or os.cpu_count() or 1
+    if not threads:
+        # Share the cores between the encoders of all processes
+        threads = max(1, (os.cpu_count() or 1) // processes)
+
+    ranges = split_at_keyframes(video_file, fps, n_frames, processes)
+    extension = os.path.splitext(output_file)[1] or ".mp4"
+
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(output_file))
+    ) as tmp_dir:
+        parts = []
+        args = []
+        for i, (start, end) in enumerate(ranges):
+            part = os.path.join(tmp_dir, f"part_{i:04d}{extension}")
+            parts.append(part)
+            args.append(
+                [
+                    video_file,
+                    source,
+                    part,
+                    start,
+                    end,
+                    fps,
+                    renderer,
+                    encoder,
+                    preset,
+                    crf,
+                    threads,
+                ]
+            )
+
+        parallelism.executeFunction(render_chunk, args, maxWorkers=processes)
+        ffmpegUtils.concatFiles(parts, output_file, audioSource=video_file)
+
+
+def overlay_video_with_data(
+    video_file,
+    csv_file,
+    output_file="output_with_overlay.mp4",
+    fps=None,
+    renderer=TEXT_RENDERER,
+    encoder="ffmpeg",
+    preset="veryfast",
+    crf=23,
+    threads=0,
+    processes=1,
+    follow=False,
+):
+    """
+    Draw the synchronized sensor values on every frame of the video.
+
+    Args:
+        - video_file (str): Path to the input video.
+        - csv_file (str or dict): Synchronized data, see open_sensor_data. A
+            CSV is read lazily and a ".npy" file is memory-mapped, so memory
+            does not grow with the clip length.
+        - output_file (str): Path of the output video.
+        - fps (float): Frame rate of the output video. Defaults to the one of
+            the source video.
+        - renderer (str): "puttext" to call cv2.putText for every line or
+            "atlas" to blend pre-rendered glyphs (TextOverlay). Use
+            benchmark_renderers to check which one is faster on a machine.
+        - encoder (str): "ffmpeg" to pipe the frames to ffmpeg (libx264, with
+            the source audio copied) or "opencv" for cv2.VideoWriter.
+        - preset (str): x264 preset for the ffmpeg encoder.
+        - crf (int): x264 quality for the ffmpeg encoder, lower is better.
+        - threads (int): Threads of the ffmpeg encoder, 0 lets ffmpeg decide.
+        - processes (int): Number of processes. With more than one the video
+            is split in keyframe-aligned chunks rendered in parallel and joined
+            with ffmpeg, see overlay_video_parallel. None uses every core.
+        - follow (bool): Start rendering while the CSV is still being
+            written, waiting for the rows that are missing.
+    """
+    draw_text = get_text_renderer(renderer)
+
+    cap = cv2.VideoCapture(video_file)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    fps = fps or cap.get(cv2.CAP_PROP_FPS) or 60
+
+    if processes is None or processes > 1:
+        cap.release()
+        if isinstance(csv_file, dict):
+            csv_file = np.column_stack([csv_file[name] for name in SYNC_COLUMNS])
+        overlay_video_parallel(
+            video_file,
+            csv_file,
+            output_file,
+            fps,
+            n_frames,
+            processes,
+            renderer,
+            encoder,
+            preset,
+            crf,
+            threads,
+        )
+        return
+
+    out = open_video_writer(
+        output_file, width, height, fps, encoder, video_file, preset, crf, threads
+    )
+    if out is None:
+        print(
+            "No se pudo inicializar ningún codec válido. Revisa tu instalación de OpenCV y FFmpeg."
+        )
+        cap.release()
+        return
+
+    with open_sensor_data(csv_file, follow=follow) as data:
+        try:
+            _render_frames(cap, out, data, draw_text, 0, n_frames)
+        finally:
+            cap.release()
+            out.release()
     cv2.destroyAllWindows()
 
 
+def benchmark_renderers(width=3840, height=2160, n_frames=300):
+    """
+    Compare the frames/sec of the putText and atlas renderers on synthetic
+    frames of the given size.
+
+    Returns:
+        - results (dict): Frames/sec of each renderer.
+    """
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    values = rng.normal(size=(n_frames, 7)) * 10
+
+    results = {}
+    for name, draw_text in (
+        ("puttext", draw_text_puttext),
+        ("atlas", TextOverlay().draw),
+    ):
+        start = time.perf_counter()
+        for row in values:
+            draw_text(frame, format_overlay_lines(*row))
+        results[name] = n_frames / (time.perf_counter() - start)
+        print(f"{name}: {results[name]:.1f} frames/s ({width}x{height})")
+    return results
+
+
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "--benchmark":
+        benchmark_renderers(*map(int, sys.argv[2:]))
+        sys.exit(0)
+
     if len(sys.argv) != 3:
         print(
-            "Uso: python3 superponer_overlay.py <archivo_video.mp4> <archivo_csv.csv>"
+            "Uso: python3 superponer_overlay.py <archivo_video.mp4> <archivo_csv.csv>\n"
+            "     python3 superponer_overlay.py --benchmark [ancho alto frames]"
         )
         sys.exit(1)
 
@@ -1,12 +1,16 @@
 from concurrent.futures import ProcessPoolExecutor
 
 
-def executeFunction(func, args: list) -> None:
+def executeFunction(func, args: list, maxWorkers: int = None) -> None:
     """
     This function executes a given function with dynamic arguments using a ProcessPoolExecutor.
+    The number of processes can be limited with maxWorkers (defaults to the CPU count).
     """
+    if not args:
+        return
+
     futures = []
-    with ProcessPoolExecutor() as executor:
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
         for arg in args:
             # Submit the function with the argument
             # It takes all the arguments in a list
@@ -0,0 +1,347 @@
+import os
+import time
+import argparse
+import functools
+import cv2
+from ultralytics import YOLO
+import config
+import parallelism
+import ffmpegUtils
+import sync
+import overlay
+import data_analysis
+
+
+def _fan_out(cap, n_frames, data, draw_text, out, needed, stats):
+    """
+    Decode every frame of cap once and hand it to every consumer.
+
+    The frames are drawn with the sensor values and written to out. The frames
+    marked in needed are copied before drawing and yielded as
+    (frame index, frame) for the object detection.
+
+    Args:
+        - cap (cv2.VideoCapture): Opened input video.
+        - n_frames (int): Number of frames to read.
+        - data: Synchronized values, see overlay.open_sensor_data. None
+            disables the overlay.
+        - draw_text (function): Function that draws the text lines.
+        - out: Video writer for the overlay, None disables it.
+        - needed (np.ndarray): Mask of the frames for the detection, None if
+            there is no detection.
+        - stats (dict): Counters of the pass, updated in place.
+
+    Yields:
+        - (int, np.ndarray): Index and clean copy of every needed frame.
+    """
+    for frame_idx in range(n_frames):
+        wanted = needed is not None and needed[frame_idx]
+
+        if out is None:
+            # Only the detection reads pixels, the other frames are skipped
+            if not cap.grab():
+                break
+            if not wanted:
+                continue
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
+            stats["decoded"] += 1
+            yield frame_idx, frame
+            continue
+
+        ret, frame = cap.read()
+        if not ret:
+            break
+        stats["decoded"] += 1
+
+        if wanted:
+            yield frame_idx, frame.copy()
+
+        values = data.get(frame_idx)
+        if values is not None:
+            draw_text(frame, overlay.format_overlay_lines(*values))
+        out.write(frame)
+        stats["written"] += 1
+
+
+def process_clip(
+    video_file,
+    gcsv_file,
+    output_dir,
+    mode="nearest",
+    sync_format="csv",
+    draw_overlay=True,
+    detect=True,
+    top_n=3,
+    confidence=0.3,
+    batch_size=8,
+    stride=1,
+    candidates_only=False,
+    model_name="yolov8n.pt",
+    renderer=overlay.TEXT_RENDERER,
+    encoder="ffmpeg",
+    preset="veryfast",
+    crf=23,
+    threads=0,
+    queue_size=32,
+    synced_file=None,
+):
+    """
+    Synchronize, overlay, detect and summarize one clip decoding the video
+    only once.
+
+    The sensor data is synchronized in memory and the brakes and segments are
+    computed from it before the video is opened, so the single decoding pass
+    already knows which frames need YOLO. Every decoded frame is drawn and
+    encoded for the overlay video, and the needed frames are also sent to YOLO
+    in batches from a separate thread. The summary is cut from the overlay
+    video with ffmpeg without decoding it again.
+
+    When the detection cache already has every needed frame, YOLO is not run.
+    If neither the overlay nor YOLO need pixels, the video is not decoded.
+
+    Args:
+        - video_file (str): Path to the video.
+        - gcsv_file (str): Path to the GCSV file recorded with the video.
+        - output_dir (str): Folder for the outputs.
+        - mode (str): Alignment mode, see sync.align_samples.
+        - sync_format (str): Format of the synchronized data, one of
+            sync.SAVERS without the dot, see sync.saver_for.
+        - draw_overlay (bool): Write the video with the sensor values.
+        - detect (bool): Count cars and persons with YOLO for the score.
+        - top_n (int): Number of segments of the summary, 0 disables it.
+        - confidence, batch_size, stride, candidates_only, model_name: See
+            data_analysis.detectar_objetos_yolo.
+        - renderer, encoder, preset, crf, threads: See
+            overlay.overlay_video_with_data.
+        - queue_size (int): Frames buffered between the decoding and YOLO.
+        - synced_file (str): Data already synchronized with sync for this
+            video. It is read instead of synchronizing again.
+
+    Returns:
+        - outputs (dict): Paths of the files that were written, by kind.
+    """
+    start_time = time.perf_counter()
+    save_synced = sync.saver_for(f".{sync_format}")
+    stem = os.path.splitext(os.path.basename(video_file))[0]
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {}
+
+    # Synchronize the sensor data, the result stays in memory for the rest
+    video_info = sync.probe_video(video_file)
+    fps = video_info["fps"] or 60
+    n_frames = video_info["frames"]
+    if synced_file is not None:
+        synced_data = sync.load_synced(synced_file)
+        outputs["sync"] = synced_file
+    else:
+        synced_data = sync.synchronize_data(
+            sync.load_gcsv_file(gcsv_file), n_frames, fps=fps, mode=mode
+        )
+        outputs["sync"] = os.path.join(output_dir, f"{stem}.{sync_format}")
+        save_synced(synced_data, outputs["sync"])
+
+    # Brakes and segments only need the sensor data
+    data = data_analysis.cargar_csv(synced_data)
+    thresholds = data_analysis.calcular_umbrales(data)
+    frenazos = data_analysis.detectar_frenazos(data, thresholds)
+    segments_df = data_analysis.segmentar_video(data, frenazos)
+
+    frame_segments, analysed, needed = data_analysis.seleccionar_frames(
+        n_frames, fps, segments_df, stride, candidates_only
+    )
+
+    cajas = None
+    names = None
+    cache_path = None
+    if detect:
+        cache_path = data_analysis.ruta_cache(video_file, model_name, confidence)
+        cajas = data_analysis.buscar_cache_detecciones(cache_path, needed)
+        if cajas is not None:
+            names = list(cajas["names"])
+    run_yolo = detect and cajas is None
+
+    stats = {"decoded": 0, "written": 0}
+    if draw_overlay or run_yolo:
+        cap = cv2.VideoCapture(video_file)
+        out = None
+        sensor_values = None
+        finished = False
+        try:
+            draw_text = None
+            if draw_overlay:
+                outputs["overlay"] = os.path.join(output_dir, f"{stem}_overlay.mp4")
+                out = overlay.open_video_writer(
+                    outputs["overlay"],
+                    int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                    int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                    fps,
+                    encoder,
+                    video_file,
+                    preset,
+                    crf,
+                    threads,
+                )
+                if out is None:
+                    raise RuntimeError(f"No se pudo abrir el vídeo de salida de {stem}")
+                sensor_values = overlay.open_sensor_data(synced_data)
+                draw_text = overlay.get_text_renderer(renderer)
+
+            frames = _fan_out(
+                cap,
+                n_frames,
+                sensor_values,
+                draw_text,
+                out,
+                needed if run_yolo else None,
+                stats,
+            )
+            if run_yolo:
+                model = YOLO(model_name)
+                # Joins the decoding thread also when the model fails
+                cajas = data_analysis.inferir_lotes(
+                    model,
+                    frames,
+                    confidence,
+                    batch_size,
+                    stats.setdefault("stages", {}),
+                    queue_size=queue_size,
+                )
+                names = data_analysis.nombres_modelo(model)
+                data_analysis.guardar_cache_detecciones(cache_path, cajas, names)
+            else:
+                for _ in frames:
+                    pass
+            finished = True
+        finally:
+            cap.release()
+            if sensor_values is not None:
+                sensor_values.close()
+            if out is not None and finished:
+                out.release()
+            elif out is not None:
+                # Stop ffmpeg without hiding the original error and drop the
+                # partial overlay
+                try:
+                    out.release()
+                except (OSError, RuntimeError):
+                    pass
+                if os.path.exists(outputs["overlay"]):
+                    os.remove(outputs["overlay"])
+
+    if detect:
+        detecciones = data_analysis.construir_detecciones(
+            cajas, names, frame_segments, analysed, needed
+        )
+        segments_df = data_analysis.calcular_puntuacion(
+            segments_df, detecciones=detecciones
+        )
+    else:
+        # Without detections the score only counts the brakes
+        segments_df = data_analysis.calcular_puntuacion(segments_df)
+
+    outputs["segments"] = os.path.join(output_dir, f"{stem}_segments.csv")
+    segments_df.to_csv(outputs["segments"], index=False)
+
+    if top_n and len(segments_df):
+        # The summary is cut from the already encoded overlay when there is one
+        top_segments = (
+            segments_df.sort_values(by="score", ascending=False)
+            .head(top_n)
+            .sort_values(by="start")
+        )
+        outputs["summary"] = os.path.join(output_dir, f"{stem}_resumen.mp4")
+        ffmpegUtils.cutAndConcat(
+            outputs.get("overlay", video_file),
+            list(zip(top_segments["start"], top_segments["end"])),
+            outputs["summary"],
+        )
+
+    elapsed = time.perf_counter() - start_time
+    print(
+        f"{stem}: {stats['decoded']} frames decodificados, "
+        f"{stats['written']} escritos, {len(frenazos)} frenazos, "
+        f"{'YOLO' if run_yolo else 'sin YOLO'}, {elapsed:.1f} s"
+    )
+    return outputs
+
+
+def run(video_dir=None, gcsv_dir=None, output_dir=None, processes=None, **kwargs):
+    """
+    Process every video/GCSV pair of the configured folders with process_clip.
+
+    Args:
+        - video_dir (str): Folder with the videos. Defaults to the configured one.
+        - gcsv_dir (str): Folder with the GCSV files. Defaults to the configured one.
+        - output_dir (str): Folder for the outputs. Defaults to the configured one.
+        - processes (int): Clips processed at the same time, None uses every core.
+        - kwargs: Options of process_clip.
+
+    Returns:
+        - pairs (list): The (video, gcsv) pairs that were processed.
+    """
+    video_dir = video_dir or config.getVideoFolder()
+    gcsv_dir = gcsv_dir or config.getGCSVFolder()
+    output_dir = output_dir or config.getOutputFolder()
+
+    pairs = sync.find_pairs(video_dir, gcsv_dir)
+    args = [[video_file, gcsv_file, output_dir] for video_file, gcsv_file in pairs]
+    parallelism.executeFunction(
+        functools.partial(process_clip, **kwargs), args, maxWorkers=processes
+    )
+    return pairs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Synchronize, overlay, detect and summarize in one video pass."
+    )
+    parser.add_argument("-v", "--video", help="Single video file to process")
+    parser.add_argument("-g", "--gcsv", help="GCSV file of the single video")
+    parser.add_argument("-o", "--output", help="Output folder")
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=sync.ALIGN_MODES,
+        default="nearest",
+        help="Alignment mode",
+    )
+    parser.add_argument(
+        "--format",
+        choices=[extension[1:] for extension in sync.SAVERS],
+        default="csv",
+        help="Format of the synchronized data",
+    )
+    parser.add_argument(
+        "--no-overlay", action="store_true", help="Do not write the overlay video"
+    )
+    parser.add_argument(
+        "--no-detect", action="store_true", help="Score the segments without YOLO"
+    )
+    parser.add_argument("--top", type=int, default=3, help="Segments of the summary")
+    parser.add_argument("--stride", type=int, default=1, help="YOLO frame stride")
+    parser.add_argument(
+        "-p", "--processes", type=int, default=1, help="Clips processed in parallel"
+    )
+    args = parser.parse_args()
+    if args.stride < 1:
+        parser.error("--stride must be at least 1")
+
+    options = {
+        "mode": args.mode,
+        "sync_format": args.format,
+        "draw_overlay": not args.no_overlay,
+        "detect": not args.no_detect,
+        "top_n": args.top,
+        "stride": args.stride,
+    }
+    if args.video or args.gcsv:
+        if not (args.video and args.gcsv):
+            parser.error("--video and --gcsv must be used together")
+        process_clip(
+            args.video, args.gcsv, args.output or config.getOutputFolder(), **options
+        )
+    else:
+        pairs = run(output_dir=args.output, processes=args.processes, **options)
+        print(f"Proceso completado. {len(pairs)} vídeos procesados.")
@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import glob
+import config
+
+PRESET_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "presets")
+REQUIRED_KEYS = ("calibration_data", "stabilization", "version")
+
+
+def _resolve(path: str) -> str:
+    """
+    Absolute path of a preset, relative paths being taken from the project
+    folder like the ones in config.json.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
+
+def load_preset(preset_path: str) -> dict:
+    """
+    Parse and validate a Gyroflow preset.
+
+    Args:
+        - preset_path (str): Path to the preset JSON file.
+
+    Returns:
+        - preset (dict): The parsed preset.
+
+    Raises:
+        - ValueError: If the file is not JSON or lacks a required section.
+    """
+    with open(preset_path, "r") as f:
+        try:
+            preset = json.load(f)
+        except ValueError as error:
+            raise ValueError(f"{preset_path} is not valid JSON: {error}") from None
+
+    if not isinstance(preset, dict):
+        raise ValueError(f"{preset_path} is not a Gyroflow preset")
+    missing = [key for key in REQUIRED_KEYS if key not in preset]
+    if missing:
+        raise ValueError(f"{preset_path} is missing {missing}")
+    if "calib_dimension" not in preset["calibration_data"]:
+        raise ValueError(f"{preset_path} has no lens calibration")
+    return preset
+
+
+class PresetRegistry:
+    """
+    Gyroflow preset of every allowed device.
+
+    The preset of a device is the path given in the "presets" mapping of the
+    configuration or, by default, "presets/<device>_presets.json". Every
+    preset is parsed and validated once, when the registry is created. The
+    device of a video is read from the transfer manifests written when it was
+    offloaded (see fileHandling.TransferManifest), so a folder with videos of
+    several cameras gets the right preset for each one.
+
+    The default "preset_path" is only used for the videos whose device is
+    unknown. An allowed device without a valid preset of its own has no
+    preset, as the default one would be calibrated for another lens.
+    """
+
+    def __init__(self, preset_folder: str = None):
+        """
+        Args:
+            preset_folder (str): Folder with the "<device>_presets.json"
+                files. Defaults to the presets folder of the project.
+        """
+        configuration = config.getConfiguration()
+        preset_folder = preset_folder or PRESET_FOLDER
+        mapping = configuration.get("presets", {})
+
+        self.devices = set(configuration["allowed_devices"])
+        self.presets = {}  # Device -> (path, parsed preset)
+        self.errors = {}  # Device, or "preset_path", -> why it has no preset
+        for device in self.devices:
+            if device in mapping:
+                path = _resolve(mapping[device])
+            else:
+                path = os.path.abspath(
+                    os.path.join(preset_folder, f"{device}_presets.json")
+                )
+            if not os.path.exists(path):
+                self.errors[device] = f"{path} does not exist"
+                continue
+            try:
+                self.presets[device] = (path, load_preset(path))
+            except (OSError, ValueError) as error:
+                self.errors[device] = str(error)
+                print(f"Preset of {device} ignored: {error}")
+
+        # Used for the videos whose device is unknown
+        self.default = None
+        default_path = configuration.get("preset_path")
+        if default_path:
+            path = os.path.normpath(_resolve(default_path))
+            try:
+                load_preset(path)
+                self.default = path
+            except (OSError, ValueError) as error:
+                self.errors["preset_path"] = str(error)
+                print(f"Default preset ignored: {error}")
+
+        self._devices = {}  # Folder -> {filename: device}
+
+    def preset_for_device(self, device: str) -> str:
+        """
+        Path of the preset of a device, the default one if the device is
+        unknown, or None if there is no preset to use (see missing).
+        """
+        if device in self.presets:
+            return self.presets[device][0]
+        if device in self.devices:
+            return None
+        return self.default
+
+    def missing(self, video_path: str) -> str:
+        """
+        Why a video has no preset, to report it.
+        """
+        device = self.device_of(video_path)
+        if device in self.devices:
+            return f"{device} has no preset: {self.errors[device]}"
+        reason = self.errors.get("preset_path", "no preset_path is configured")
+        return f"unknown device {device} and no default preset: {reason}"
+
+    def _load_devices(self, folder: str) -> dict:
+        devices = {}
+        for manifest_path in glob.glob(os.path.join(folder, ".transfers", "*.json")):
+            try:
+                with open(manifest_path, "r") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            serial = os.path.splitext(os.path.basename(manifest_path))[0]
+            device = manifest.get("device") or serial
+            for entry in manifest.get("files", {}).values():
+                if "destination" in entry:
+                    devices[os.path.basename(entry["destination"])] = device
+        return devices
+
+    def device_of(self, video_path: str) -> str:
+        """
+        Device a video was offloaded from, or None if it is not recorded.
+        """
+        folder = os.path.abspath(os.path.dirname(video_path))
+        if folder not in self._devices:
+            self._devices[folder] = self._load_devices(folder)
+        return self._devices[folder].get(os.path.basename(video_path))
+
+    def preset_for(self, video_path: str) -> str:
+        """
+        Path of the preset for a video, from the device it came from.
+        """
+        return self.preset_for_device(self.device_of(video_path))
+
+
+if __name__ == "__main__":
+    # Print the preset of every video given as argument
+    registry = PresetRegistry()
+    for video_path in sys.argv[1:]:
+        print(registry.preset_for(video_path))
@@ -7,7 +7,6 @@
 # TODO get from config file
 VIDEO_DIR="videos"
 GCSV_DIR="gcsv"
-PRESET_PATH="./presets/9C33-6BBD_presets.json"  # TODO get from config file
 
 # Función de ayuda
 usage() {
@@ -45,6 +44,13 @@ GCSV_PATH="${SCRIPT_DIR}/${GCSV_DIR}/${GCSV_FILENAME}"
 # Mostrar el directorio actual
 pwd
 
+# Preset del dispositivo del que se descargó el vídeo
+PRESET_PATH=$(python3 "${SCRIPT_DIR}/presetRegistry.py" "$VIDEO_PATH")
+if [ -z "$PRESET_PATH" ] || [ "$PRESET_PATH" = "None" ]; then
+    echo "No hay preset para $VIDEO_PATH"
+    exit 1
+fi
+
 # Construir y ejecutar el comando
 CMD="./Gyroflow/gyroflow \"$VIDEO_PATH\" -g \"$GCSV_PATH\" --preset \"$PRESET_PATH\" -f"
 echo "Ejecutando: $CMD"
@@ -1,8 +1,209 @@
 import os
-import json
+import time
 import subprocess
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import config
 from config import getConfiguration
+import sync
+from presetRegistry import PresetRegistry
+
+STABILIZED_SUFFIX = "_stabilized"  # Added by gyroflow to the output name
+DURATION_TOLERANCE = 0.5  # Seconds an output may differ from its input
+
+
+def stabilized_path(video_path: str) -> str:
+    """
+    Path of the video written by gyroflow for video_path, next to it.
+    """
+    stem = os.path.splitext(video_path)[0]
+    return f"{stem}{STABILIZED_SUFFIX}.mp4"
+
+
+def is_complete(video_path: str, output_path: str) -> bool:
+    """
+    Check if a stabilized output exists and is complete.
+
+    The output must be newer than its input and, when ffprobe is available,
+    last as long as it. A run that was killed leaves a shorter or unreadable
+    file that is stabilized again.
+    """
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return False
+    if os.path.getmtime(output_path) < os.path.getmtime(video_path):
+        return False
+    try:
+        expected = sync.probe_video(video_path)["duration"]
+        actual = sync.probe_video(output_path)["duration"]
+    except FileNotFoundError:
+        # No ffprobe, the duration cannot be checked
+        return True
+    except (OSError, RuntimeError, ValueError, KeyError):
+        return False
+    return abs(expected - actual) <= DURATION_TOLERANCE
+
+
+def build_command(
+    binary: str, video_path: str, gcsv_path: str, preset_path: str
+) -> list:
+    """
+    Command that stabilizes one video with gyroflow.
+    """
+    return [binary, video_path, "-g", gcsv_path, "--preset", preset_path, "-f"]
+
+
+def stabilize(
+    video_path: str,
+    gcsv_path: str,
+    preset_path: str,
+    binary: str = None,
+    retries: int = 0,
+) -> bool:
+    """
+    Stabilize one video, trying again up to retries times if gyroflow fails
+    or its output is not complete.
+
+    Returns:
+        - ok (bool): Whether the output is complete. False also when gyroflow
+            cannot be run.
+    """
+    binary = binary or config.getStabilizationSettings()["binary"]
+    command = build_command(binary, video_path, gcsv_path, preset_path)
+    output_path = stabilized_path(video_path)
+
+    for attempt in range(retries + 1):
+        print(f"Running: {' '.join(command)}")
+        start = time.perf_counter()
+        try:
+            result = subprocess.run(
+                command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+            )
+        except OSError as error:
+            # Missing or not executable, trying again would not help
+            print(f"Could not run {binary} on {os.path.basename(video_path)}: {error}")
+            return False
+        if result.returncode == 0 and is_complete(video_path, output_path):
+            print(
+                f"Stabilized {os.path.basename(video_path)} "
+                f"in {time.perf_counter() - start:.1f} s"
+            )
+            return True
+        print(
+            f"Gyroflow failed on {os.path.basename(video_path)} "
+            f"(attempt {attempt + 1}/{retries + 1}): {result.stderr.strip()[-500:]}"
+        )
+        if attempt < retries:
+            time.sleep(min(2**attempt, 30))
+    return False
+
+
+def _available_memory_gb() -> float:
+    """
+    Memory that can be used without swapping, in GB.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024**2
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024**3
+
+
+def job_budget(
+    cores_per_job: float, memory_per_job_gb: float, max_jobs: int = None
+) -> int:
+    """
+    Number of gyroflow processes that fit in the machine.
+
+    Args:
+        - cores_per_job (float): Cores used by one gyroflow process.
+        - memory_per_job_gb (float): Memory used by one gyroflow process.
+        - max_jobs (int): Upper limit, None for no limit.
+
+    Returns:
+        - jobs (int): At least 1.
+    """
+    by_cores = (os.cpu_count() or 1) // max(cores_per_job, 1)
+    available_gb = _available_memory_gb()
+    by_memory = available_gb // max(memory_per_job_gb, 0.1)
+    jobs = int(min(by_cores, by_memory))
+    if max_jobs is not None:
+        jobs = min(jobs, max_jobs)
+    return max(jobs, 1)
+
+
+def find_pending(video_dir: str, gcsv_dir: str) -> list:
+    """
+    Video/GCSV pairs of the configured folders without a complete output.
+
+    Returns:
+        - pairs (list): (video_path, gcsv_path) tuples.
+    """
+    return [
+        (video_path, gcsv_path)
+        for video_path, gcsv_path in sync.find_pairs(video_dir, gcsv_dir)
+        if not is_complete(video_path, stabilized_path(video_path))
+    ]
+
+
+def stabilize_all(
+    video_dir: str = None,
+    gcsv_dir: str = None,
+    preset_path: str = None,
+    binary: str = None,
+    jobs: int = None,
+    retries: int = None,
+) -> dict:
+    """
+    Stabilize every pending pair of the folders, several at once.
+
+    The number of simultaneous gyroflow processes comes from the core and
+    memory budget of the "stabilization" settings, see job_budget.
+
+    Args:
+        - video_dir (str): Folder with the videos. Defaults to the configured one.
+        - gcsv_dir (str): Folder with the GCSV files. Defaults to the configured one.
+        - preset_path (str): Preset for every video. By default every video
+            uses the preset of the device it was offloaded from, see
+            presetRegistry.PresetRegistry.
+        - binary (str): Gyroflow executable, e.g. a stub for tests.
+        - jobs (int): Processes at once. Defaults to the budget.
+        - retries (int): Extra attempts for a failed video.
+
+    Returns:
+        - results (dict): Whether every processed video was stabilized.
+    """
+    settings = config.getStabilizationSettings()
+    video_dir = video_dir or config.getVideoFolder()
+    gcsv_dir = gcsv_dir or config.getGCSVFolder()
+    binary = binary or settings["binary"]
+    retries = settings["retries"] if retries is None else retries
+    jobs = jobs or job_budget(
+        settings["cores_per_job"], settings["memory_per_job_gb"], settings["max_jobs"]
+    )
+
+    pending = find_pending(video_dir, gcsv_dir)
+    print(f"{len(pending)} videos to stabilize, {jobs} at a time")
+
+    registry = None if preset_path else PresetRegistry()
+    results = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for video_path, gcsv_path in pending:
+            preset = preset_path or registry.preset_for(video_path)
+            if preset is None:
+                print(
+                    f"No preset for {video_path}, skipping: {registry.missing(video_path)}"
+                )
+                results[video_path] = False
+                continue
+            futures[video_path] = executor.submit(
+                stabilize, video_path, gcsv_path, preset, binary, retries
+            )
+    results.update({video: future.result() for video, future in futures.items()})
+    return results
 
 
 def run():
@@ -15,25 +216,31 @@ def run():
     - gcsv_path: Path to the GCSV file containing gyro data.
     - preset_path: Path to the preset file for gyroflow. This must be precomputed using
         the gyroflow GUI and is specific to the device used to record the video.
+
+    Without a video and GCSV file every pending pair of the configured folders
+    is stabilized, see stabilize_all.
     """
 
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Process video files with gyroflow.")
-    parser.add_argument(
-        "-v", "--video_filename", required=True, help="Name of the video file"
-    )
-    parser.add_argument(
-        "-g", "--gcsv_filename", required=True, help="Name of the GCSV file"
-    )
+    parser.add_argument("-v", "--video_filename", help="Name of the video file")
+    parser.add_argument("-g", "--gcsv_filename", help="Name of the GCSV file")
+    parser.add_argument("-b", "--binary", help="Gyroflow executable")
+    parser.add_argument("-j", "--jobs", type=int, help="Videos stabilized at once")
     args = parser.parse_args()
 
+    if not (args.video_filename or args.gcsv_filename):
+        results = stabilize_all(binary=args.binary, jobs=args.jobs)
+        failed = [video for video, ok in results.items() if not ok]
+        print(f"{len(results) - len(failed)} videos stabilized, {len(failed)} failed")
+        return
+    if not (args.video_filename and args.gcsv_filename):
+        parser.error("--video_filename and --gcsv_filename must be used together")
+
     config = getConfiguration()
 
     video_dir = config["paths"]["video_dir"]
     gcsv_dir = config["paths"]["gcsv_dir"]
-    preset_path = config[
-        "preset_path"
-    ]  # the precomputed presets to use, depend on the specific device
 
     # Configure file names and preset path
     video_filename = args.video_filename
@@ -43,20 +250,14 @@ def run():
     video_path = os.path.join(video_dir, video_filename)
     gcsv_path = os.path.join(gcsv_dir, gcsv_filename)
 
-    # Construct the command
-    command = [
-        "./Gyroflow/gyroflow",
-        video_path,
-        "-g",
-        gcsv_path,
-        "--preset",
-        preset_path,
-        "-f",
-    ]
+    # the precomputed presets to use, depend on the specific device
+    registry = PresetRegistry()
+    preset_path = registry.preset_for(video_path)
+    if preset_path is None:
+        parser.error(f"No preset for {video_path}: {registry.missing(video_path)}")
 
     # Run the command
-    print(f"Running: {' '.join(command)}")
-    subprocess.run(command, check=False)
+    stabilize(video_path, gcsv_path, preset_path, args.binary)
 
 
 if __name__ == "__main__":
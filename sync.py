@@ -1,144 +1,832 @@
-import csv
+import os
+import json
+import argparse
 import subprocess
-from bisect import bisect_left
+import time
+import importlib.util
+import numpy as np
+import pandas as pd
+import config
+import fileHandling
+import parallelism
 
 
-def read_gcsv_file(gcsv_file):
-    times = []
-    rx_vals, ry_vals, rz_vals = [], [], []
-    ax_vals, ay_vals, az_vals = [], [], []
-    time_offset = 0.0  # Offset acumulativo de tiempo
+GCSV_COLUMNS = ["t", "rx", "ry", "rz", "ax", "ay", "az"]
+
+
+def _read_gcsv_header(lines) -> dict:
+    """
+    Read the GCSV header lines up to (and including) the column line.
+
+    Only the header is consumed, so the numeric block can be read next from
+    the same file or iterator.
+
+    Args:
+        - lines (iterable): Lines of the GCSV file. Empty or None entries are
+            skipped.
+
+    Returns:
+        - scales (dict): The "tscale", "gscale" and "ascale" values.
+    """
+    scales = {"tscale": None, "gscale": None, "ascale": None}
+    for line in lines:
+        if not line:
+            continue
+        row = line.strip().split(",")
+        if row[0] == "t":
+            break
+        if len(row) >= 2 and row[0] in scales:
+            scales[row[0]] = float(row[1])
+
+    missing = [name for name, value in scales.items() if value is None]
+    if missing:
+        raise ValueError(f"GCSV header is missing {missing}")
+    return scales
+
+
+def follow_lines(f, follow: bool = False, timeout: float = 10.0):
+    """
+    Yield the complete lines of a binary file as text.
+
+    With follow=True the file may still be growing: when there is no complete
+    line yet None is yielded once, so the caller can handle what it already
+    has, and the lines are waited for up to timeout seconds without new data.
+
+    Args:
+        - f (file): File opened in binary mode.
+        - follow (bool): Wait for lines that are not written yet.
+        - timeout (float): Seconds to wait for new data when following.
+
+    Yields:
+        - line (str): The next line, or None while waiting.
+    """
+    waited = 0.0
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if line.endswith(b"\n"):
+            waited = 0.0
+            yield line.decode()
+            continue
+        if not follow:
+            if line:
+                yield line.decode()
+            return
+        if waited >= timeout:
+            return
+        if waited == 0.0:
+            yield None
+        # Incomplete line: go back and wait for the writer
+        f.seek(position)
+        time.sleep(0.05)
+        waited += 0.05
+
+
+def iter_gcsv_blocks(
+    gcsv_file: str, block_rows: int = 4096, follow: bool = False, timeout: float = 10.0
+):
+    """
+    Read a GCSV file in blocks of scaled rows, without loading it whole.
+
+    With follow=True the file can still be being copied or recorded. A
+    partial block is returned whenever the reader has to wait, so rows are
+    handed over as soon as they are written.
+
+    Args:
+        - gcsv_file (str): Path to the GCSV file.
+        - block_rows (int): Maximum rows per block.
+        - follow (bool): Wait for rows that are not written yet.
+        - timeout (float): Seconds to wait for new rows when following.
+
+    Yields:
+        - block (np.ndarray): Array of shape (n, 7), see parse_gcsv_file.
+    """
+    with open(gcsv_file, "rb") as f:
+        lines = follow_lines(f, follow, timeout)
+        scales = _read_gcsv_header(lines)
+        scale = np.array(
+            [scales["tscale"]] + [scales["gscale"]] * 3 + [scales["ascale"]] * 3
+        )
+
+        rows = []
+        for line in lines:
+            if line:
+                rows.append(line)
+            if rows and (line is None or len(rows) >= block_rows):
+                yield _parse_rows(rows, len(GCSV_COLUMNS))[0] * scale
+                rows = []
+        if rows:
+            yield _parse_rows(rows, len(GCSV_COLUMNS))[0] * scale
+
+
+def _is_complete_row(line: str, n_columns: int) -> bool:
+    """
+    Check if a line has at least n_columns fields and they are numbers.
+    """
+    fields = line.split(",")
+    if len(fields) < n_columns:
+        return False
+    try:
+        for field in fields[:n_columns]:
+            float(field)
+    except ValueError:
+        return False
+    return True
 
+
+def _parse_rows(rows: list, n_columns: int) -> tuple:
+    """
+    Parse a list of comma separated lines into an (n, n_columns) array.
+
+    Rows with fewer fields or with fields that are not numbers, like the last
+    row of a file that is still being written or was cut when the card was
+    pulled, are skipped. They are only looked for when the bulk parse fails.
+
+    Returns:
+        - data (np.ndarray): The parsed rows.
+        - skipped (int): Number of rows that were skipped.
+    """
+    try:
+        return np.loadtxt(rows, delimiter=",", usecols=range(n_columns), ndmin=2), 0
+    except ValueError:
+        pass
+
+    lines = [row for row in rows if row.strip()]
+    complete = [row for row in lines if _is_complete_row(row, n_columns)]
+    skipped = len(lines) - len(complete)
+    if not complete:
+        return np.empty((0, n_columns)), skipped
+    data = np.loadtxt(complete, delimiter=",", usecols=range(n_columns), ndmin=2)
+    return data, skipped
+
+
+def _sidecar_path(gcsv_file: str) -> str:
+    """
+    Path of the binary cache written next to a GCSV file.
+    """
+    return gcsv_file + ".npy"
+
+
+def _parse_gcsv(gcsv_file: str) -> tuple:
+    """
+    Parse a GCSV file, see parse_gcsv_file.
+
+    Returns:
+        - data (np.ndarray): The scaled rows.
+        - skipped (int): Number of incomplete rows that were skipped.
+    """
     with open(gcsv_file, newline="") as f:
-        reader = csv.reader(f)
-        tscale = gscale = ascale = None
-        header_passed = False
-        for row in reader:
-            if not header_passed:
-                if len(row) > 0 and row[0] == "t":
-                    header_passed = True
-                else:
-                    if len(row) >= 2:
-                        if row[0] == "tscale":
-                            tscale = float(row[1])
-                        if row[0] == "gscale":
-                            gscale = float(row[1])
-                        if row[0] == "ascale":
-                            ascale = float(row[1])
-                continue
-
-            if len(row) >= 7:
-                t_raw = float(row[0])
-                rx_raw = float(row[1])
-                ry_raw = float(row[2])
-                rz_raw = float(row[3])
-                ax_raw = float(row[4])
-                ay_raw = float(row[5])
-                az_raw = float(row[6])
-
-                timestamp = time_offset + t_raw * tscale
-                rx = rx_raw * gscale
-                ry = ry_raw * gscale
-                rz = rz_raw * gscale
-                ax = ax_raw * ascale
-                ay = ay_raw * ascale
-                az = az_raw * ascale
-
-                times.append(timestamp)
-                rx_vals.append(rx)
-                ry_vals.append(ry)
-                rz_vals.append(rz)
-                ax_vals.append(ax)
-                ay_vals.append(ay)
-                az_vals.append(az)
-
-    return times, rx_vals, ry_vals, rz_vals, ax_vals, ay_vals, az_vals
-
-
-def get_total_frames(video_file):
-    ffprobe_cmd = [
-        "ffprobe",
-        "-v",
-        "error",
-        "-select_streams",
-        "v:0",
-        "-count_frames",
-        "-show_entries",
-        "stream=nb_read_frames",
-        "-of",
-        "csv=p=0",
-        video_file,
-    ]
+        scales = _read_gcsv_header(iter(f.readline, ""))
+        data, skipped = _parse_rows(f.readlines(), len(GCSV_COLUMNS))
+
+    data[:, 0] *= scales["tscale"]
+    data[:, 1:4] *= scales["gscale"]
+    data[:, 4:7] *= scales["ascale"]
+    return data, skipped
+
+
+def parse_gcsv_file(gcsv_file: str) -> np.ndarray:
+    """
+    Parse a GCSV file into a single scaled column array.
+
+    The header scales are read first and the numeric block is loaded with one
+    bulk call, so no Python work is done per sample. Incomplete rows, like
+    the last one of a file that is still being written, are skipped.
+
+    Args:
+        - gcsv_file (str): Path to the GCSV file.
+
+    Returns:
+        - data (np.ndarray): Array of shape (n, 7) with the columns in
+            GCSV_COLUMNS order, already multiplied by their scales.
+    """
+    return _parse_gcsv(gcsv_file)[0]
+
+
+def load_gcsv_file(gcsv_file: str, use_cache: bool = True) -> np.ndarray:
+    """
+    Load a GCSV file, reusing its binary sidecar when it is up to date.
+
+    The first load parses the text and writes "<gcsv_file>.npy" next to it.
+    Later loads memory-map that file instead of parsing again. The sidecar
+    is ignored when it is older than the GCSV, and it is not written when
+    incomplete rows were skipped, since the file is probably still growing.
+
+    Args:
+        - gcsv_file (str): Path to the GCSV file.
+        - use_cache (bool): Read and write the sidecar. Defaults to True.
+
+    Returns:
+        - data (np.ndarray): Array of shape (n, 7), see parse_gcsv_file.
+    """
+    sidecar = _sidecar_path(gcsv_file)
+
+    if use_cache and os.path.exists(sidecar):
+        if os.path.getmtime(sidecar) >= os.path.getmtime(gcsv_file):
+            return np.load(sidecar, mmap_mode="r")
+
+    data, skipped = _parse_gcsv(gcsv_file)
+
+    if use_cache and not skipped:
+        # Write to a temporary file first so a crash never leaves a broken cache
+        tmp_path = sidecar + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, data)
+            os.replace(tmp_path, sidecar)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return data
+
+
+def read_gcsv_file(gcsv_file):
+    """
+    Read a GCSV file as separate time, gyro and accelerometer columns.
+    """
+    data = load_gcsv_file(gcsv_file)
+    return tuple(data[:, i] for i in range(len(GCSV_COLUMNS)))
+
+
+PROBE_CACHE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "probe_cache.json"
+)
+
+
+def _run_ffprobe(args: list) -> dict:
+    """
+    Run ffprobe with JSON output and return the parsed result.
+    """
+    command = ["ffprobe", "-v", "error", "-of", "json"] + args
     result = subprocess.run(
-        ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
     )
-    if result.returncode == 0:
-        return int(result.stdout.strip())
-    else:
+    if result.returncode != 0:
         raise RuntimeError(f"ffprobe failed: {result.stderr}")
+    return json.loads(result.stdout)
 
 
-def synchronize_data(
-    times, rx_vals, ry_vals, rz_vals, ax_vals, ay_vals, az_vals, total_frames, fps=60
-):
-    frame_times = [n / fps for n in range(total_frames)]
-    sensor_index = 0
-    synced_data = []
-
-    for frame_num, t_frame in enumerate(frame_times):
-        idx = bisect_left(times, t_frame, lo=sensor_index)
-
-        if idx == 0:
-            closest_idx = 0
-        elif idx >= len(times):
-            closest_idx = len(times) - 1
-        else:
-            prev_idx = idx - 1
-            next_idx = idx
-            if abs(times[prev_idx] - t_frame) <= abs(times[next_idx] - t_frame):
-                closest_idx = prev_idx
-            else:
-                closest_idx = next_idx
-
-        timestamp = times[closest_idx]
-        rx_val = rx_vals[closest_idx]
-        ry_val = ry_vals[closest_idx]
-        rz_val = rz_vals[closest_idx]
-        ax_val = ax_vals[closest_idx]
-        ay_val = ay_vals[closest_idx]
-        az_val = az_vals[closest_idx]
-
-        synced_data.append(
-            [frame_num, timestamp, rx_val, ry_val, rz_val, ax_val, ay_val, az_val]
+def _parse_rate(rate: str) -> float:
+    """
+    Convert an ffprobe rate such as "60000/1001" to a float.
+    """
+    try:
+        num, _, den = rate.partition("/")
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError, AttributeError):
+        return 0.0
+
+
+def _parse_int(value) -> int:
+    """
+    Convert an ffprobe count to int, returning 0 when it is missing.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _probe_uncached(video_file: str, decode: bool) -> dict:
+    """
+    Probe a video without using the cache, cheapest source first:
+
+    1. "nb_frames" from the container header.
+    2. Packet counting, which reads the file but decodes nothing.
+    3. duration * avg_frame_rate as an estimate.
+    4. A full decode with -count_frames, only when decode is True.
+    """
+    info = _run_ffprobe(
+        [
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "stream=nb_frames,avg_frame_rate,r_frame_rate,duration:format=duration",
+            video_file,
+        ]
+    )
+    stream = info["streams"][0] if info.get("streams") else {}
+    fps = _parse_rate(stream.get("avg_frame_rate")) or _parse_rate(
+        stream.get("r_frame_rate")
+    )
+    duration = float(
+        stream.get("duration") or info.get("format", {}).get("duration") or 0
+    )
+
+    frames = _parse_int(stream.get("nb_frames"))
+    source = "metadata"
+
+    if frames <= 0:
+        packets = _run_ffprobe(
+            [
+                "-select_streams",
+                "v:0",
+                "-count_packets",
+                "-show_entries",
+                "stream=nb_read_packets",
+                video_file,
+            ]
+        )
+        frames = _parse_int(packets["streams"][0].get("nb_read_packets"))
+        source = "packets"
+
+    if frames <= 0 and duration > 0 and fps > 0:
+        frames = int(round(duration * fps))
+        source = "duration"
+
+    if frames <= 0 and decode:
+        decoded = _run_ffprobe(
+            [
+                "-select_streams",
+                "v:0",
+                "-count_frames",
+                "-show_entries",
+                "stream=nb_read_frames",
+                video_file,
+            ]
         )
-        sensor_index = max(0, closest_idx - 1)
+        frames = _parse_int(decoded["streams"][0].get("nb_read_frames"))
+        source = "decode"
+
+    if frames <= 0:
+        raise RuntimeError(f"Could not determine the frame count of {video_file}")
+
+    if duration <= 0 and fps > 0:
+        duration = frames / fps
+
+    return {"frames": frames, "fps": fps, "duration": duration, "source": source}
+
+
+def _load_probe_cache() -> dict:
+    """
+    Load the probe cache, returning an empty one if it is missing or broken.
+    """
+    try:
+        with open(PROBE_CACHE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_probe_cache(key: str, value: dict) -> None:
+    """
+    Add an entry to the probe cache. The file is re-read before writing so
+    parallel processes do not drop each other's entries.
+    """
+    cache = _load_probe_cache()
+    cache[key] = value
+    tmp_path = f"{PROBE_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, PROBE_CACHE_FILE)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def probe_video(video_file: str, decode: bool = False, use_cache: bool = True) -> dict:
+    """
+    Get the frame count, frame rate and duration of a video.
+
+    The container metadata is used whenever possible, the video is only
+    decoded when decode is True and nothing else worked. Results are cached
+    in probe_cache.json keyed by path, size and modification time.
+
+    Args:
+        - video_file (str): Path to the video file.
+        - decode (bool): Allow a full decode as last resort. Defaults to False.
+        - use_cache (bool): Read and write the cache. Defaults to True.
+
+    Returns:
+        - info (dict): "frames" (int), "fps" (float), "duration" (float) and
+            "source" (str), the method that gave the frame count.
+    """
+    stat = os.stat(video_file)
+    key = f"{os.path.abspath(video_file)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    if use_cache:
+        cached = _load_probe_cache().get(key)
+        if cached is not None:
+            return cached
+
+    info = _probe_uncached(video_file, decode)
+
+    if use_cache:
+        _save_probe_cache(key, info)
+    return info
 
+
+def get_total_frames(video_file, decode=False):
+    """
+    Get the number of frames of a video, see probe_video.
+    """
+    return probe_video(video_file, decode=decode)["frames"]
+
+
+SYNC_COLUMNS = ["frame", "timestamp", "rx", "ry", "rz", "ax", "ay", "az"]
+ALIGN_MODES = ("nearest", "linear", "window")
+
+
+def _nearest_indices(times: np.ndarray, frame_times: np.ndarray) -> np.ndarray:
+    """
+    Index of the closest sensor sample for every frame time.
+    Ties are resolved towards the earlier sample.
+    """
+    idx = np.searchsorted(times, frame_times, side="left")
+    idx = np.clip(idx, 1, len(times) - 1)
+    prev_closer = np.abs(times[idx - 1] - frame_times) <= np.abs(
+        times[idx] - frame_times
+    )
+    return np.where(prev_closer, idx - 1, idx)
+
+
+def align_samples(
+    sensor_data: np.ndarray,
+    frame_times: np.ndarray,
+    mode: str = "nearest",
+    window: float = None,
+) -> np.ndarray:
+    """
+    Align sensor samples to a set of frame times in one vectorized pass.
+
+    Args:
+        - sensor_data (np.ndarray): Array of shape (n, 7) as returned by
+            load_gcsv_file, sorted by time.
+        - frame_times (np.ndarray): Time in seconds of each frame.
+        - mode (str): How to compute the value of each frame:
+            - "nearest": the closest sample (its own timestamp is kept).
+            - "linear": linear interpolation between the surrounding samples.
+            - "window": mean of the samples within +-window/2 of the frame.
+        - window (float): Width in seconds of the averaging window. Only used
+            with mode="window". Defaults to the median frame interval.
+
+    Returns:
+        - aligned (np.ndarray): Array of shape (len(frame_times), 7) with the
+            same columns as sensor_data.
+    """
+    if mode not in ALIGN_MODES:
+        raise ValueError(f"Unknown alignment mode '{mode}', use one of {ALIGN_MODES}")
+
+    sensor_data = np.asarray(sensor_data, dtype=np.float64)
+    frame_times = np.asarray(frame_times, dtype=np.float64)
+    times = sensor_data[:, 0]
+
+    if len(times) < 2:
+        return np.repeat(sensor_data[:1], len(frame_times), axis=0)
+
+    if mode == "nearest":
+        return sensor_data[_nearest_indices(times, frame_times)]
+
+    aligned = np.empty((len(frame_times), sensor_data.shape[1]))
+    aligned[:, 0] = frame_times
+
+    if mode == "linear":
+        for col in range(1, sensor_data.shape[1]):
+            aligned[:, col] = np.interp(frame_times, times, sensor_data[:, col])
+        return aligned
+
+    if window is None:
+        window = np.median(np.diff(frame_times)) if len(frame_times) > 1 else 0.0
+    half = window / 2
+
+    # Prefix sums turn every window mean into two lookups
+    cumulative = np.zeros((len(times) + 1, sensor_data.shape[1] - 1))
+    np.cumsum(sensor_data[:, 1:], axis=0, out=cumulative[1:])
+    lo = np.searchsorted(times, frame_times - half, side="left")
+    hi = np.searchsorted(times, frame_times + half, side="right")
+    counts = hi - lo
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        aligned[:, 1:] = (cumulative[hi] - cumulative[lo]) / counts[:, None]
+
+    # Frames with no sample inside their window fall back to the nearest one
+    empty = counts == 0
+    if empty.any():
+        nearest = _nearest_indices(times, frame_times[empty])
+        aligned[empty, 1:] = sensor_data[nearest, 1:]
+    return aligned
+
+
+def synchronize_data(
+    sensor_data, total_frames, fps=60, mode="nearest", window=None
+) -> dict:
+    """
+    Synchronize the sensor data with the frames of a video.
+
+    Args:
+        - sensor_data (np.ndarray): Array of shape (n, 7) from load_gcsv_file.
+        - total_frames (int): Number of frames in the video.
+        - fps (float): Frame rate of the video. Defaults to 60.
+        - mode (str): Alignment mode, see align_samples. Defaults to "nearest".
+        - window (float): Averaging window for mode="window".
+
+    Returns:
+        - synced_data (dict): One NumPy array per name in SYNC_COLUMNS.
+            It can be passed directly to pandas.DataFrame.
+    """
+    frames = np.arange(total_frames, dtype=np.int64)
+    aligned = align_samples(sensor_data, frames / fps, mode=mode, window=window)
+
+    synced_data = {"frame": frames}
+    for col, name in enumerate(SYNC_COLUMNS[1:]):
+        synced_data[name] = aligned[:, col]
     return synced_data
 
 
 def save_to_csv(synced_data, output_csv):
-    with open(output_csv, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["frame", "timestamp", "rx", "ry", "rz", "ax", "ay", "az"])
-        for row in synced_data:
-            writer.writerow(row)
+    """
+    Write the synchronized columns to a CSV file.
+    """
+    columns = np.column_stack([synced_data[name] for name in SYNC_COLUMNS])
+    np.savetxt(
+        output_csv,
+        columns,
+        delimiter=",",
+        fmt=["%d"] + ["%.9g"] * (len(SYNC_COLUMNS) - 1),
+        header=",".join(SYNC_COLUMNS),
+        comments="",
+    )
 
 
-gcsv_file = "Runcam6_0002.gcsv"
-video_file = "Runcam6_0002.MP4"
-total_frames = get_total_frames(video_file)
+def save_to_npy(synced_data, output_npy):
+    """
+    Write the synchronized columns to a .npy file of shape (n, 8) in
+    SYNC_COLUMNS order, which overlay.py can memory-map.
+    """
+    columns = np.column_stack([synced_data[name] for name in SYNC_COLUMNS])
+    tmp_path = output_npy + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, columns.astype(np.float64))
+    os.replace(tmp_path, output_npy)
+
+
+def _compact_columns(synced_data) -> dict:
+    """
+    Columns with the compact types of the columnar formats: frame as int32
+    and the sensor values as float32.
+    """
+    return {
+        name: np.asarray(
+            synced_data[name], dtype=np.int32 if name == "frame" else np.float32
+        )
+        for name in SYNC_COLUMNS
+    }
+
+
+def save_to_npz(synced_data, output_npz):
+    """
+    Write the synchronized columns to a compressed .npz file, one array per
+    column with frame as int32 and the rest as float32.
+    """
+    tmp_path = output_npz + ".tmp.npz"
+    np.savez_compressed(tmp_path, **_compact_columns(synced_data))
+    os.replace(tmp_path, output_npz)
 
-# Leer archivo GCSV
-(times, rx_vals, ry_vals, rz_vals, ax_vals, ay_vals, az_vals) = read_gcsv_file(
-    gcsv_file
-)
 
-# Sincronizar datos
-synced_data = synchronize_data(
-    times, rx_vals, ry_vals, rz_vals, ax_vals, ay_vals, az_vals, total_frames
+def save_to_parquet(synced_data, output_parquet):
+    """
+    Write the synchronized columns to a Parquet file with the same types as
+    save_to_npz. Needs pyarrow or fastparquet, see PARQUET_ENGINE.
+    """
+    tmp_path = output_parquet + ".tmp"
+    pd.DataFrame(_compact_columns(synced_data)).to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, output_parquet)
+
+
+# Parquet engine pandas will use, None if there is none installed
+PARQUET_ENGINE = next(
+    (
+        engine
+        for engine in ("pyarrow", "fastparquet")
+        if importlib.util.find_spec(engine) is not None
+    ),
+    None,
 )
 
-# Guardar en CSV
-save_to_csv(synced_data, "video_sensor_sync.csv")
+SAVERS = {
+    ".csv": save_to_csv,
+    ".npy": save_to_npy,
+    ".npz": save_to_npz,
+}
+if PARQUET_ENGINE is not None:
+    SAVERS[".parquet"] = save_to_parquet
+
+
+def saver_for(extension: str):
+    """
+    Function of SAVERS that writes the files with an extension, the CSV one
+    for unknown extensions. Checked before the work, so a missing Parquet
+    engine does not fail after the synchronization.
+
+    Raises:
+        - ValueError: For ".parquet" when no Parquet engine is installed.
+    """
+    extension = extension.lower()
+    if extension == ".parquet" and extension not in SAVERS:
+        raise ValueError("Parquet files need pyarrow or fastparquet")
+    return SAVERS.get(extension, save_to_csv)
+
+
+def _table_columns(table: np.ndarray) -> dict:
+    synced_data = {name: table[:, i] for i, name in enumerate(SYNC_COLUMNS)}
+    synced_data["frame"] = synced_data["frame"].astype(np.int64)
+    return synced_data
+
+
+def load_csv(input_csv):
+    """
+    Read a synchronized CSV file.
+    """
+    return _table_columns(np.loadtxt(input_csv, delimiter=",", skiprows=1, ndmin=2))
 
-print("Proceso completado. Archivo CSV generado correctamente.")
+
+def load_npy(input_npy):
+    """
+    Read a .npy file written by save_to_npy.
+    """
+    return _table_columns(np.load(input_npy))
+
+
+def load_npz(input_npz):
+    """
+    Read a .npz file written by save_to_npz.
+    """
+    with np.load(input_npz) as columns:
+        return {name: columns[name] for name in SYNC_COLUMNS}
+
+
+def load_parquet(input_parquet):
+    """
+    Read a Parquet file written by save_to_parquet.
+    """
+    table = pd.read_parquet(input_parquet, columns=SYNC_COLUMNS)
+    return {name: table[name].to_numpy() for name in SYNC_COLUMNS}
+
+
+LOADERS = {
+    ".csv": load_csv,
+    ".npy": load_npy,
+    ".npz": load_npz,
+    ".parquet": load_parquet,
+}
+
+
+def load_synced(input_file) -> dict:
+    """
+    Read a synchronized file written with any of SAVERS.
+
+    Args:
+        - input_file (str): Path to the file, its extension picks the format.
+
+    Returns:
+        - synced_data (dict): The columns, as returned by synchronize_data.
+    """
+    extension = os.path.splitext(input_file)[1].lower()
+    return LOADERS.get(extension, load_csv)(input_file)
+
+
+def is_up_to_date(output_file: str, input_files: list) -> bool:
+    """
+    Check if an output file exists and is newer than all of its inputs.
+    """
+    if not os.path.exists(output_file):
+        return False
+    output_mtime = os.path.getmtime(output_file)
+    return all(output_mtime > os.path.getmtime(path) for path in input_files)
+
+
+def find_pairs(video_dir: str, gcsv_dir: str) -> list:
+    """
+    Pair every video with the GCSV file that has the same name.
+
+    Args:
+        - video_dir (str): Folder with the video files.
+        - gcsv_dir (str): Folder with the GCSV files.
+
+    Returns:
+        - pairs (list): List of (video_path, gcsv_path) tuples sorted by name.
+    """
+    if not os.path.isdir(video_dir) or not os.path.isdir(gcsv_dir):
+        return []
+
+    gcsvs = {
+        os.path.splitext(filename)[0]: os.path.join(gcsv_dir, filename)
+        for filename in os.listdir(gcsv_dir)
+        if fileHandling.is_gcsv(filename)
+    }
+
+    pairs = []
+    for filename in sorted(os.listdir(video_dir)):
+        stem = os.path.splitext(filename)[0]
+        if fileHandling.is_video(filename) and stem in gcsvs:
+            pairs.append((os.path.join(video_dir, filename), gcsvs[stem]))
+    return pairs
+
+
+def sync_pair(
+    video_file: str, gcsv_file: str, output_csv: str, mode: str = "nearest"
+) -> None:
+    """
+    Probe a video, parse its GCSV file and write the synchronized CSV.
+
+    Args:
+        - video_file (str): Path to the video file.
+        - gcsv_file (str): Path to the GCSV file recorded with the video.
+        - output_csv (str): Path of the file to write. Its extension picks
+            the format, see SAVERS.
+        - mode (str): Alignment mode, see align_samples.
+
+    Returns:
+        - None
+    """
+    save = saver_for(os.path.splitext(output_csv)[1])
+    video_info = probe_video(video_file)
+    sensor_data = load_gcsv_file(gcsv_file)
+    synced_data = synchronize_data(
+        sensor_data, video_info["frames"], fps=video_info["fps"] or 60, mode=mode
+    )
+    save(synced_data, output_csv)
+
+
+def run(
+    video_dir: str = None,
+    gcsv_dir: str = None,
+    output_dir: str = None,
+    mode: str = "nearest",
+    force: bool = False,
+    output_format: str = "csv",
+) -> list:
+    """
+    Synchronize every video/GCSV pair of the configured folders in parallel.
+
+    Pairs whose output CSV is newer than both inputs are skipped.
+
+    Args:
+        - video_dir (str): Folder with the videos. Defaults to the configured one.
+        - gcsv_dir (str): Folder with the GCSV files. Defaults to the configured one.
+        - output_dir (str): Folder for the CSV files. Defaults to the configured one.
+        - mode (str): Alignment mode, see align_samples.
+        - force (bool): Synchronize again even if the output is up to date.
+        - output_format (str): Extension of the outputs, one of SAVERS.
+
+    Returns:
+        - outputs (list): Paths of the CSV files that were written.
+    """
+    saver_for(f".{output_format}")
+    video_dir = video_dir or config.getVideoFolder()
+    gcsv_dir = gcsv_dir or config.getGCSVFolder()
+    output_dir = output_dir or config.getSyncFolder()
+    os.makedirs(output_dir, exist_ok=True)
+
+    args = []
+    for video_file, gcsv_file in find_pairs(video_dir, gcsv_dir):
+        stem = os.path.splitext(os.path.basename(video_file))[0]
+        output_csv = os.path.join(output_dir, f"{stem}.{output_format}")
+        if not force and is_up_to_date(output_csv, [video_file, gcsv_file]):
+            continue
+        args.append([video_file, gcsv_file, output_csv, mode])
+
+    parallelism.executeFunction(sync_pair, args)
+    return [arg[2] for arg in args]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Synchronize GCSV sensor data with video frames."
+    )
+    parser.add_argument("-v", "--video", help="Single video file to synchronize")
+    parser.add_argument("-g", "--gcsv", help="GCSV file of the single video")
+    parser.add_argument(
+        "-o", "--output", help="Output CSV (single pair) or folder (batch)"
+    )
+    parser.add_argument(
+        "-m", "--mode", choices=ALIGN_MODES, default="nearest", help="Alignment mode"
+    )
+    parser.add_argument(
+        "-f", "--force", action="store_true", help="Ignore up to date outputs"
+    )
+    parser.add_argument(
+        "--format",
+        choices=[extension[1:] for extension in SAVERS],
+        default="csv",
+        help="Output format in batch mode",
+    )
+    args = parser.parse_args()
+
+    if args.video or args.gcsv:
+        if not (args.video and args.gcsv):
+            parser.error("--video and --gcsv must be used together")
+        sync_pair(
+            args.video, args.gcsv, args.output or "video_sensor_sync.csv", args.mode
+        )
+        print("Proceso completado. Archivo CSV generado correctamente.")
+    else:
+        outputs = run(
+            output_dir=args.output,
+            mode=args.mode,
+            force=args.force,
+            output_format=args.format,
+        )
+        print(f"Proceso completado. {len(outputs)} archivos generados.")